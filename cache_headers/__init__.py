@@ -0,0 +1 @@
+default_app_config = "cache_headers.apps.CacheHeadersConfig"
@@ -0,0 +1,202 @@
+"""Analysis of the rules for the system checks and the
+validate_cache_headers management command."""
+
+import re
+from timeit import default_timer
+
+from cache_headers import vcl
+
+# Pieces of a pattern between regex syntax
+FRAGMENT = re.compile(r"(?:[\w\-/.,;:=&%~]|\\[^\w\s])+")
+
+# Input lengths for the backtracking test. Small steps first since
+# exponential patterns blow up quickly.
+SIZES = (4, 8, 12, 16, 20, 24, 32, 64, 128, 256, 512, 1024, 2048, 4096)
+
+# Characters that are repeated to build adversarial input in addition to the
+# literal characters of the pattern
+FILLERS = "a0/-."
+
+
+def load():
+    """Return the (policies, ruleset) of the middleware. Importing the
+    middleware compiles the rules, so errors in the rules are raised here."""
+
+    from cache_headers import middleware
+    return middleware.POLICIES, middleware.ruleset
+
+
+def all_rules(ruleset):
+    """Yield all rules of the rule set, the ones set with the cache_policy
+    decorator included."""
+
+    for rule in ruleset.rules:
+        yield rule
+    for rule in ruleset.resolver_rules.values():
+        yield rule
+    seen = set()
+    for regex, match in vcl.url_patterns():
+        rule = getattr(match.func, "_dch_rule", None)
+        if (rule is not None) and (rule.name not in seen):
+            seen.add(rule.name)
+            yield rule
+
+
+def describe(rule):
+    if rule.pattern is None:
+        return rule.name
+    return rule.pattern.pattern
+
+
+def unknown_policies(policies, ruleset):
+    """Return the rules that refer to a policy that does not exist."""
+
+    return [r for r in all_rules(ruleset) if r.cache_type not in policies]
+
+
+def outcome(rule):
+    return (
+        rule.timeout, rule.cache_type, rule.stale_while_revalidate,
+        rule.stale_if_error, rule.status_timeouts
+    )
+
+
+def shadowed(rules):
+    """Return (rule, by) tuples for pattern rules that can never apply
+    because an earlier rule matches every URL they match. This can only be
+    decided for rules whose pattern is a literal prefix or URL."""
+
+    result = []
+    for n, rule in enumerate(rules):
+        value = vcl.literal(rule)
+        if value is None:
+            continue
+        text, exact = value
+        for earlier in rules[:n]:
+            other = vcl.literal(earlier)
+            if exact:
+                # A single URL is shadowed if the earlier rule matches it
+                covered = earlier.pattern.match(text) is not None
+            elif other is not None:
+                covered = (not other[1]) and text.startswith(other[0])
+            else:
+                covered = False
+            if covered:
+                result.append((rule, earlier))
+                break
+    return result
+
+
+def witnesses(rule, rules):
+    """Yield URLs the rule matches. The fragments of the other rules are
+    appended to its literal prefix to find URLs other rules may claim."""
+
+    value = vcl.literal(rule)
+    if value is None:
+        return
+    text, exact = value
+    yield text
+    if exact:
+        return
+    for other in rules:
+        if other.pattern is None:
+            continue
+        for fragment in FRAGMENT.findall(other.pattern.pattern):
+            fragment = re.sub(r"\\(.)", r"\1", fragment).lstrip("/")
+            if fragment:
+                yield text + fragment
+
+
+def overlaps(rules):
+    """Return (rule, by, url) tuples where url is matched by rule but gets
+    the different outcome of the earlier rule by. Shadowed rules are not
+    included."""
+
+    skip = set(rule for rule, by in shadowed(rules))
+    result = []
+    for n, rule in enumerate(rules):
+        if rule in skip:
+            continue
+        found = False
+        for url in witnesses(rule, rules):
+            for earlier in rules[:n]:
+                if outcome(earlier) == outcome(rule):
+                    continue
+                if earlier.pattern.match(url):
+                    result.append((rule, earlier, url))
+                    found = True
+                    break
+            if found:
+                break
+    return result
+
+
+def adversarial_inputs(pattern):
+    """Yield callables returning adversarial input of a given length for
+    pattern. The input starts with the literal prefix of the pattern and
+    repeats characters of the pattern, and ends with a character that makes
+    the match fail as late as possible."""
+
+    match = re.match(r"\^?((?:[\w\-/.]|\\[^\w\s])*)", pattern.pattern)
+    prefix = re.sub(r"\\(.)", r"\1", match.group(1))
+    characters = []
+    for c in re.sub(r"\\.", "", pattern.pattern) + FILLERS:
+        if (c.isalnum() or c in "/-._~") and (c not in characters):
+            characters.append(c)
+    for c in characters[:20]:
+        yield lambda n, c=c: prefix + c * n + "\x00"
+        yield lambda n, c=c: prefix + (c + "/") * (n // 2) + "\x00"
+
+
+def backtracking(pattern, limit=0.05):
+    """Return a (length, seconds) tuple for the first adversarial input on
+    which matching pattern took longer than limit seconds, or None."""
+
+    for make in adversarial_inputs(pattern):
+        for size in SIZES:
+            text = make(size)
+            start = default_timer()
+            pattern.match(text)
+            elapsed = default_timer() - start
+            if elapsed > limit:
+                return len(text), elapsed
+    return None
+
+
+def cost_profile(ruleset, iterations=100):
+    """Return a dictionary describing the cost of looking up a path that is
+    not in the lookup cache."""
+
+    urls = []
+    for rule in ruleset.rules:
+        urls.extend(list(witnesses(rule, ()))[:1])
+    urls.append("/cache-headers-no-match/")
+
+    matcher = ruleset.matcher
+    start = default_timer()
+    for n in range(iterations):
+        for url in urls:
+            matcher._resolve(url)
+    elapsed = default_timer() - start
+
+    slowest = []
+    for rule in ruleset.rules:
+        start = default_timer()
+        for n in range(iterations):
+            for url in urls:
+                rule.pattern.match(url)
+        slowest.append((default_timer() - start, rule))
+    slowest.sort(key=lambda x: x[0], reverse=True)
+
+    return {
+        "rules": len(ruleset.rules),
+        "resolver_rules": len(ruleset.resolver_rules),
+        "combined": matcher.combined is not None,
+        "query_matcher": ruleset.query_matcher is not None,
+        "lookup_cache_size": matcher.cache.max_entries,
+        "mean_resolve_ns": int(elapsed * 1e9 / (iterations * len(urls))),
+        "slowest": [
+            (describe(rule), int(t * 1e9 / (iterations * len(urls))))
+            for t, rule in slowest[:5]
+        ]
+    }
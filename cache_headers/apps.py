@@ -0,0 +1,10 @@
+from django.apps import AppConfig
+
+
+class CacheHeadersConfig(AppConfig):
+    name = "cache_headers"
+    verbose_name = "Cache Headers"
+
+    def ready(self):
+        # Register the system checks
+        from cache_headers import checks
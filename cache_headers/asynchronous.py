@@ -0,0 +1,94 @@
+"""Async code paths. This module is only imported on Python 3.5 and later."""
+
+import asyncio
+import time
+from timeit import default_timer
+
+from asgiref.sync import sync_to_async
+from django.core.cache import caches
+
+
+async def acall(self, request):
+    """The async counterpart of MiddlewareMixin.__call__ for
+    CacheHeadersMiddleware. Rule resolution, session key validation and
+    declared policies run directly on the event loop. Only work that may load
+    the user or session is handed to a thread."""
+
+    # Imported here because the middleware module imports this one
+    from cache_headers.middleware import INSTRUMENT
+
+    response = await self.get_response(request)
+    start = default_timer()
+    response = await process_response(self, request, response)
+    if INSTRUMENT:
+        return self.report(request, response, start)
+    return response
+
+
+async def process_response(self, request, response):
+
+    # Imported here because the middleware module imports this one
+    from cache_headers.middleware import (
+        RULES_CHECK_INTERVAL, refresh_rules, rules_due
+    )
+
+    # Check for new rules before the lookup does, off the event loop
+    if RULES_CHECK_INTERVAL and rules_due():
+        await sync_to_async(refresh_rules, thread_sensitive=True)()
+
+    # Login and logout set cookies from the session
+    if hasattr(request, "_dch_auth_event"):
+        return await sync_to_async(
+            self.handle, thread_sensitive=True
+        )(request, response)
+
+    response, rule = self.resolve(request, response)
+    if rule is None:
+        return response
+    if self.needs_identity(request, rule):
+        return await sync_to_async(
+            self.apply, thread_sensitive=True
+        )(request, response, rule)
+    return self.apply(request, response, rule)
+
+
+async def microcache_acall(self, request):
+    """The async counterpart of MiddlewareMixin.__call__ for
+    MicroCacheMiddleware. Waiting for the render of another request happens
+    on the event loop. Sync views run in a single thread under ASGI, so
+    blocking in that thread would hold up the render waited for."""
+
+    response, wait = await sync_to_async(
+        self.start, thread_sensitive=True
+    )(request)
+    if wait is not None:
+        response = await microcache_wait(self, request, wait)
+    if response is None:
+        response = await self.get_response(request)
+    return await sync_to_async(
+        self.process_response, thread_sensitive=True
+    )(request, response)
+
+
+async def microcache_wait(self, request, wait):
+    """The async counterpart of MicroCacheMiddleware.wait."""
+
+    # Imported here because the microcache module imports this one
+    from cache_headers.microcache import BACKEND, POLL_INTERVAL
+
+    event, deadline, version, path = wait
+    get = sync_to_async(
+        lambda: self.get(request, caches[BACKEND], version, path),
+        thread_sensitive=True
+    )
+    while time.time() < deadline:
+        if event is None:
+            response = await get()
+            if response is not None:
+                return response
+        elif event.is_set():
+            break
+        await asyncio.sleep(POLL_INTERVAL)
+    if event is not None:
+        return await get()
+    return None
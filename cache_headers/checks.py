@@ -0,0 +1,33 @@
+from django.core.checks import Error, Warning, register
+
+from cache_headers import analysis
+
+
+@register()
+def check_rules(app_configs, **kwargs):
+    """Check that the rules compile, refer to existing policies and are not
+    shadowed by other rules."""
+
+    try:
+        policies, ruleset = analysis.load()
+    except Exception as exc:
+        return [Error(
+            "The cache headers rules could not be loaded: %s" % exc,
+            id="cache_headers.E001"
+        )]
+
+    messages = []
+    for rule in analysis.unknown_policies(policies, ruleset):
+        messages.append(Error(
+            "Rule %s refers to the unknown policy %s."
+                % (analysis.describe(rule), rule.cache_type),
+            hint="Add the policy to the policies setting.",
+            id="cache_headers.E002"
+        ))
+    for rule, by in analysis.shadowed(ruleset.rules):
+        messages.append(Warning(
+            "Rule %s never applies because rule %s matches first."
+                % (analysis.describe(rule), analysis.describe(by)),
+            id="cache_headers.W001"
+        ))
+    return messages
@@ -0,0 +1,23 @@
+from cache_headers.rules import Rule, parse_status_timeouts
+
+
+def cache_policy(age, policy, stale_while_revalidate=0, stale_if_error=0,
+                 status_timeouts=None):
+    """Decorator that sets the rule for a view. policy is the name of a
+    policy, eg. "all-users". The rule is found through the resolver match of
+    the request and takes precedence over all rules in the settings.
+    status_timeouts maps response statuses other than 200 to their timeout.
+
+    Decorate the result of as_view for class based views."""
+
+    def decorator(view):
+        # Name class based views after the class
+        named = getattr(view, "view_class", view)
+        view._dch_rule = Rule(
+            None, age, policy, 0, stale_while_revalidate, stale_if_error,
+            "view:%s.%s" % (named.__module__, named.__name__),
+            parse_status_timeouts(status_timeouts or {})
+        )
+        return view
+
+    return decorator
@@ -0,0 +1,69 @@
+"""Edge Side Includes let the reverse cache assemble a page from fragments
+that are cached under their own policy. The shell of a page can then be
+cached once for all users while eg. a header widget is cached per user.
+
+Fragments are ordinary views with their own URL and rule. Include them with
+include() or the esi_include template tag. Varnish announces ESI support with
+the Surrogate-Capability request header, see generate_vcl. Without it the
+fragments are rendered in place and the page is not cached, since it then
+contains the content of the fragments."""
+
+import copy
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+from django.urls import resolve, reverse
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+
+# Tells the reverse cache to process the ESI of a response
+SURROGATE_CONTROL = 'content="ESI/1.0"'
+
+# Responses that include fragments vary on this request header
+SURROGATE_CAPABILITY = "Surrogate-Capability"
+
+
+def supports_esi(request):
+    """Return True if a surrogate in front of Django processes ESI."""
+
+    return "ESI/1.0" in request.META.get("HTTP_SURROGATE_CAPABILITY", "")
+
+
+def fragment_path(name, *args, **kwargs):
+    """Return the path of a fragment. name is a path or a URL name to be
+    reversed with args and kwargs."""
+
+    if name.startswith("/"):
+        return name
+    return reverse(name, args=args, kwargs=kwargs)
+
+
+def render_inline(request, path):
+    """Return the content of the fragment at path rendered for request."""
+
+    match = resolve(urlsplit(path).path)
+    fragment = copy.copy(request)
+    fragment.path = fragment.path_info = urlsplit(path).path
+    fragment.resolver_match = match
+    response = match.func(fragment, *match.args, **match.kwargs)
+    if hasattr(response, "render"):
+        response.render()
+    return response.content.decode(response.charset)
+
+
+def include(request, name, *args, **kwargs):
+    """Return the markup that includes a fragment in a response to request.
+    name is a path or a URL name to be reversed with args and kwargs."""
+
+    path = fragment_path(name, *args, **kwargs)
+    # The response depends on a request header anyone can send
+    request._dch_vary_surrogate = True
+    if supports_esi(request):
+        request._dch_esi = True
+        return mark_safe('<esi:include src="%s"/>' % escape(path))
+    request._dch_esi_inline = True
+    return mark_safe(render_inline(request, path))
@@ -0,0 +1,309 @@
+"""Invalidate content in Varnish by purging URLs or banning regexes.
+
+Requests are queued and sent by a background thread. Requests that arrive
+within a short interval of each other are deduplicated, bans are combined into
+as few regexes as possible, and every node is reached over a persistent
+connection."""
+
+import logging
+import re
+import threading
+import time
+
+try:
+    from http.client import HTTPConnection, HTTPException
+except ImportError:
+    from httplib import HTTPConnection, HTTPException
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+
+from cache_headers.tags import to_tags
+
+
+try:
+    NODES = settings.CACHE_HEADERS["varnish-nodes"]
+except (KeyError, AttributeError):
+    NODES = []
+
+try:
+    TIMEOUT = settings.CACHE_HEADERS["varnish-timeout"]
+except (KeyError, AttributeError):
+    TIMEOUT = 5
+
+# Headers that carry the regex of a BAN request. See sample.vcl and the
+# output of the generate_vcl command.
+BAN_HEADER = "X-Ban-Url"
+TAGS_BAN_HEADER = "X-Ban-Tags"
+
+# Characters with a special meaning in a regex. re.escape escapes more or
+# fewer characters depending on the Python version.
+SPECIAL_CHARACTERS = re.compile(r"([\\.^$|?*+()\[\]{}])")
+
+# Varnish limits the size of a request header so very long combined regexes
+# are split over several bans.
+MAX_BAN_LENGTH = 4000
+
+logger = logging.getLogger("django")
+
+
+class Dispatcher(object):
+    """Send PURGE and BAN requests to a number of Varnish nodes from a
+    background thread."""
+
+    def __init__(self, nodes, interval=0.1, timeout=TIMEOUT, max_wait=1,
+                 max_items=1000):
+        self.nodes = [urlsplit(node) for node in nodes]
+        self.interval = interval
+        self.timeout = timeout
+        self.max_wait = max_wait
+        self.max_items = max_items
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._connections = {}
+
+    def add(self, method, value, header=None):
+        """Queue a request. For PURGE value is a path or absolute URL, for BAN
+        it is a regex sent in header."""
+
+        if not self.nodes:
+            return
+        self._queue.put((method, header, value))
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="cache-headers-invalidation"
+                )
+                self._thread.daemon = True
+                self._thread.start()
+
+    def flush(self):
+        """Block until all queued requests have been sent."""
+
+        self._queue.join()
+
+    def close(self):
+        """Send all queued requests and close the connections to the
+        nodes."""
+
+        self.flush()
+        for connection in list(self._connections.values()):
+            connection.close()
+        self._connections.clear()
+
+    def collect(self):
+        """Block until an item is queued and return it along with whatever
+        else arrives within the interval. A steady stream of items is cut off
+        max_wait seconds after the first item or at max_items items."""
+
+        items = [self._queue.get()]
+        deadline = time.time() + self.max_wait
+        try:
+            while len(items) < self.max_items:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                items.append(
+                    self._queue.get(timeout=min(self.interval, remaining))
+                )
+        except queue.Empty:
+            pass
+        return items
+
+    def _run(self):
+        while True:
+            items = self.collect()
+            try:
+                self.send(items)
+            except Exception:
+                logger.exception("Unable to invalidate Varnish content")
+            finally:
+                for _ in items:
+                    self._queue.task_done()
+
+    def batch(self, items):
+        """Return the requests needed for items as (method, header, value)
+        tuples. Duplicates are dropped and bans on the same header are
+        combined."""
+
+        seen = set()
+        requests = []
+        bans = {}
+        for item in items:
+            if item in seen:
+                continue
+            seen.add(item)
+            method, header, value = item
+            if method == "BAN":
+                if header not in bans:
+                    bans[header] = []
+                    # Keep the position of the first ban on the header
+                    requests.append(header)
+                bans[header].append(value)
+            else:
+                requests.append(item)
+
+        result = []
+        for request in requests:
+            if request in bans:
+                for regex in self.combine(bans[request]):
+                    result.append(("BAN", request, regex))
+            else:
+                result.append(request)
+        return result
+
+    def combine(self, regexes):
+        """Yield the regexes merged into as few alternations as possible."""
+
+        current = []
+        length = 0
+        for regex in regexes:
+            if current and (length + len(regex) + 5 > MAX_BAN_LENGTH):
+                yield self.alternation(current)
+                current = []
+                length = 0
+            current.append(regex)
+            length += len(regex) + 5
+        if current:
+            yield self.alternation(current)
+
+    def alternation(self, regexes):
+        if len(regexes) == 1:
+            return regexes[0]
+        return "|".join("(?:%s)" % regex for regex in regexes)
+
+    def send(self, items):
+        for method, header, value in self.batch(items):
+            for node in self.nodes:
+                self.request(node, method, header, value)
+
+    def request(self, node, method, header, value):
+        headers = {}
+        if method == "BAN":
+            path = "/"
+            headers[header] = value
+        else:
+            url = urlsplit(value)
+            path = url.path or "/"
+            if url.query:
+                path += "?" + url.query
+            if url.netloc:
+                headers["Host"] = url.netloc
+
+        # Reuse the connection to the node and retry once on a new connection
+        # if the node closed it in the meantime.
+        for attempt in (1, 2):
+            connection = self._connections.get(node.netloc)
+            if connection is None:
+                connection = HTTPConnection(
+                    node.hostname, node.port or 80, timeout=self.timeout
+                )
+                self._connections[node.netloc] = connection
+            try:
+                connection.request(method, path, headers=headers)
+                response = connection.getresponse()
+                response.read()
+            except (HTTPException, IOError):
+                connection.close()
+                del self._connections[node.netloc]
+                if attempt == 2:
+                    raise
+                continue
+            if response.status >= 400:
+                logger.warn(
+                    "Varnish node %s answered %s to %s %s" \
+                        % (node.netloc, response.status, method, value)
+                )
+            return response.status
+
+
+dispatcher = Dispatcher(NODES)
+
+
+def purge(url):
+    """Purge a path or absolute URL. Only the object cached for requests
+    without any of the hashed cookies is affected. Use ban_url to remove all
+    variants."""
+
+    dispatcher.add("PURGE", url)
+
+
+def ban(regex):
+    """Ban all objects whose URL matches regex, eg. the pattern of a rule."""
+
+    dispatcher.add("BAN", regex, BAN_HEADER)
+
+
+def escape(value):
+    """Return value escaped for use in a ban regex."""
+
+    return SPECIAL_CHARACTERS.sub(r"\\\1", value)
+
+
+def ban_url(path):
+    """Ban all variants of a path, with or without a query string."""
+
+    ban("^%s(\\?|$)" % escape(path))
+
+
+def ban_tags(*tags):
+    """Ban all objects that were tagged with any of tags. Tags may be strings
+    or model instances. See cache_headers.tags."""
+
+    dispatcher.add("BAN", "(^|\\s)(%s)(\\s|$)" % "|".join(
+        escape(tag) for tag in sorted(set(to_tags(tags)))
+    ), TAGS_BAN_HEADER)
+
+
+def register(model, get_urls=None):
+    """Ban the URLs of instances of model when they are saved or deleted.
+    get_urls is a callable that takes an instance and returns its paths. It
+    defaults to the instance's get_absolute_url.
+
+    The bans are sent once the transaction commits. Varnish would otherwise
+    fetch the old content again before the commit, or drop content for a
+    change that is rolled back."""
+
+    def handler(sender, instance, using=None, **kwargs):
+        if get_urls is None:
+            urls = [instance.get_absolute_url()]
+        else:
+            urls = get_urls(instance)
+
+        def send():
+            for url in urls:
+                ban_url(url)
+
+        transaction.on_commit(send, using=using)
+
+    uid = "cache-headers-%s.%s" % (model._meta.app_label, model._meta.model_name)
+    post_save.connect(handler, sender=model, weak=False, dispatch_uid=uid)
+    post_delete.connect(handler, sender=model, weak=False, dispatch_uid=uid)
+
+
+def register_tags(model):
+    """Ban the pages tagged with instances of model when an instance is saved
+    or deleted. The bans are sent once the transaction commits, see
+    register."""
+
+    def handler(sender, instance, using=None, **kwargs):
+        # The tag is computed now since a deleted instance loses its pk
+        tags = list(to_tags([instance]))
+        transaction.on_commit(lambda: ban_tags(*tags), using=using)
+
+    uid = "cache-headers-tags-%s.%s" \
+        % (model._meta.app_label, model._meta.model_name)
+    post_save.connect(handler, sender=model, weak=False, dispatch_uid=uid)
+    post_delete.connect(handler, sender=model, weak=False, dispatch_uid=uid)
@@ -0,0 +1,173 @@
+from __future__ import division
+
+import json
+from timeit import default_timer
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.sessions.backends.base import VALID_KEY_CHARS
+from django.core.cache import caches
+from django.core.management.base import BaseCommand
+from django.http.response import HttpResponse
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from django.utils.crypto import get_random_string
+from django.utils.functional import SimpleLazyObject
+
+from cache_headers import middleware
+from cache_headers.microcache import MicroCacheMiddleware
+from cache_headers.rules import RuleSet
+
+
+# Cache backends for the microcache. The middleware itself never uses a
+# cache, so "none" measures it without the microcache.
+CACHES = {
+    "none": None,
+    "locmem": {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache"
+        }
+    },
+    "dummy": {
+        "default": {
+            "BACKEND": "django.core.cache.backends.dummy.DummyCache"
+        }
+    }
+}
+
+BUILTIN_POLICIES = (
+    "all-users", "anonymous-only", "anonymous-and-authenticated", "per-user"
+)
+
+
+def make_timeouts(count, cache_type):
+    """Return a timeouts setting with count rules. Every tenth rule uses
+    cache_type, the rest are spread over the other built-in policies."""
+
+    others = [p for p in BUILTIN_POLICIES if p != cache_type]
+    timeouts = {}
+    for n in range(count):
+        if n % 10 == 0:
+            name = cache_type
+        else:
+            name = others[n % len(others)]
+        timeouts.setdefault(name, {}).setdefault(60 + n % 5, []).append(
+            "^/bench/%s/%d/" % (name, n)
+        )
+    return timeouts
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class Command(BaseCommand):
+    help = "Measure the cost of the cache headers middleware and print the " \
+        "results as JSON."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--rules", type=int, nargs="+", default=[10, 100, 1000],
+            help="Rule counts to measure."
+        )
+        parser.add_argument(
+            "--policies", nargs="+", default=list(BUILTIN_POLICIES),
+            help="Policies to measure."
+        )
+        parser.add_argument(
+            "--caches", nargs="+", default=sorted(CACHES.keys()),
+            choices=sorted(CACHES.keys()),
+            help="Microcache backends to measure, none for no microcache."
+        )
+        parser.add_argument(
+            "--iterations", type=int, default=2000,
+            help="Responses to process per combination."
+        )
+        parser.add_argument(
+            "--paths", type=int, default=100,
+            help="Number of distinct paths to request."
+        )
+
+    def handle(self, *args, **options):
+        results = []
+        for cache in options["caches"]:
+            caches = CACHES[cache] or settings.CACHES
+            with override_settings(DEBUG=False, CACHES=caches):
+                for count in options["rules"]:
+                    for cache_type in options["policies"]:
+                        for authenticated in (False, True):
+                            result = self.measure(
+                                count, cache_type, authenticated,
+                                options["iterations"], options["paths"],
+                                microcache=CACHES[cache] is not None
+                            )
+                            result["microcache"] = cache
+                            results.append(result)
+        self.stdout.write(json.dumps(results, indent=4, sort_keys=True))
+
+    def measure(self, count, cache_type, authenticated, iterations, paths,
+                microcache=False):
+        ruleset = RuleSet(
+            make_timeouts(count, cache_type),
+            max_entries=middleware.LOOKUP_CACHE_SIZE
+        )
+        targets = [r for r in ruleset.rules if r.cache_type == cache_type]
+        factory = RequestFactory()
+        urls = []
+        for n in range(paths):
+            rule = targets[n % len(targets)]
+            urls.append(rule.pattern.pattern.lstrip("^") + "?page=%d" % n)
+
+        cookies = {}
+        if authenticated:
+            user = User(username="benchmark")
+            # A session key in a valid format so it is validated like a real
+            # one
+            cookies[settings.SESSION_COOKIE_NAME] = get_random_string(
+                32, VALID_KEY_CHARS
+            )
+        else:
+            user = AnonymousUser()
+
+        saved = middleware.ruleset
+        middleware.ruleset = ruleset
+        try:
+            mw = middleware.CacheHeadersMiddleware(lambda request: None)
+            if microcache:
+                caches["default"].clear()
+                micro = MicroCacheMiddleware(lambda request: None)
+            timings = []
+            for n in range(iterations):
+                # The middleware leaves state on the request, so every
+                # iteration gets a new one like a real request would
+                request = factory.get(urls[n % paths])
+                request.COOKIES.update(cookies)
+                request.user = SimpleLazyObject(lambda: user)
+                start = default_timer()
+                if microcache:
+                    # Mirror MiddlewareMixin. A hit skips the inner
+                    # middleware.
+                    response = micro.process_request(request)
+                    if response is None:
+                        response = mw.process_response(request, HttpResponse())
+                    micro.process_response(request, response)
+                else:
+                    mw.process_response(request, HttpResponse())
+                timings.append(default_timer() - start)
+            stats = middleware.ruleset.matcher.cache.stats()
+        finally:
+            middleware.ruleset = saved
+
+        timings.sort()
+        total = sum(timings)
+        return {
+            "rules": count,
+            "policy": cache_type,
+            "user": "authenticated" if authenticated else "anonymous",
+            "iterations": iterations,
+            "mean_ns": int(total / iterations * 1e9),
+            "p50_ns": int(percentile(timings, 0.5) * 1e9),
+            "p99_ns": int(percentile(timings, 0.99) * 1e9),
+            "requests_per_second": int(iterations / total) if total else None,
+            "lookup_cache": stats
+        }
@@ -0,0 +1,97 @@
+from django.core.management.base import BaseCommand
+
+from cache_headers import middleware, nginx, vcl
+from cache_headers.middleware import MATCH_PATH_ONLY, POLICIES
+
+
+TEMPLATE_HEADER = """# Generated by django-cache-headers. Include in the http block of the nginx
+# configuration, or in the server block for the variables and directives.
+"""
+
+TEMPLATE_DIRECTIVES = """
+# Only cookies the policies hash on vary the cache. The other request headers
+# the policies vary on are part of the key.
+proxy_cache_key "$scheme$proxy_host$request_uri:$dch_accept_encoding$dch_esi$dch_hash_value$dch_vary_value";
+proxy_ignore_headers Vary;
+
+# URLs the middleware never caches are passed without a lookup
+proxy_cache_bypass $dch_bypass $http_authorization;
+proxy_no_cache $dch_bypass $http_authorization;"""
+
+
+class Command(BaseCommand):
+    help = "Generate an nginx proxy_cache snippet from the cache headers " \
+        "settings."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--zone",
+            help="Name of the proxy_cache_path zone to cache responses in."
+        )
+
+    def handle(self, *args, **options):
+        self.rules = middleware.ruleset.rules
+        self.resolver_rules = vcl.resolver_rules(
+            middleware.ruleset.resolver_rules
+        )
+        lines = [TEMPLATE_HEADER]
+        if MATCH_PATH_ONLY:
+            lines.extend(nginx.PATH_MAP + [""])
+
+        # The cookies to hash on per URL
+        def hash_cookies(rule):
+            return vcl.hash_cookies(POLICIES[rule.cache_type], rule.timeout)
+
+        branches = self.dispatch(hash_cookies)
+        lines.extend(nginx.maps(
+            branches, "dch_hash_cookies",
+            lambda value: nginx.string(value or ""), '""', MATCH_PATH_ONLY
+        ))
+        lines.append("")
+        names = vcl.hash_cookie_names(
+            POLICIES, self.resolver_rules + self.rules
+        )
+        cookie_lines, variables = nginx.cookie_variables(names)
+        if cookie_lines:
+            lines.extend(cookie_lines + [""])
+        values = []
+        for regex, value, query_aware in branches:
+            if value and (value not in values):
+                values.append(value)
+        lines.extend(nginx.hash_value(values, variables))
+        lines.append("")
+        lines.extend(nginx.ACCEPT_ENCODING_MAP)
+        lines.append("")
+        lines.extend(nginx.SURROGATE_CAPABILITY_MAP)
+        lines.append("")
+
+        # The request headers to key on per URL
+        def vary(rule):
+            return nginx.vary_value(nginx.vary_headers(
+                POLICIES[rule.cache_type], rule.timeout
+            ))
+
+        lines.extend(nginx.maps(
+            self.dispatch(vary), "dch_vary_value",
+            lambda value: nginx.string(value or ""), '""', MATCH_PATH_ONLY
+        ))
+        lines.append("")
+
+        # URLs that match no rule, or a rule that caches no status, bypass
+        # the cache
+        def bypass(rule):
+            return "0" if (rule.timeout or rule.status_timeouts) else "1"
+
+        lines.extend(nginx.maps(
+            self.dispatch(bypass), "dch_bypass", nginx.string, '"1"',
+            MATCH_PATH_ONLY
+        ))
+        lines.append(TEMPLATE_DIRECTIVES)
+        if options["zone"]:
+            lines.append("proxy_cache %s;" % options["zone"])
+        self.stdout.write("\n".join(lines))
+
+    def dispatch(self, outcome):
+        return vcl.dispatch(
+            self.rules, outcome, MATCH_PATH_ONLY, first=self.resolver_rules
+        )
@@ -1,14 +1,46 @@
-from __future__ import print_function
-
-from django.conf import settings
-from django.contrib.auth.models import User
 from django.core.management.base import BaseCommand, CommandError
 from django.db import transaction
-from django.http.response import HttpResponse
-from django.test.client import RequestFactory
 
-from cache_headers.middleware import POLICIES, rules
+from cache_headers import middleware, vcl
+from cache_headers.invalidation import TAGS_BAN_HEADER
+from cache_headers.middleware import MATCH_PATH_ONLY, POLICIES
+from cache_headers.tags import TAGS_HEADER
+
+
+TEMPLATE_RECV = """
+sub vcl_recv {
+    # Ban objects by the tags in their %(tags)s header. Issued by
+    # cache_headers.invalidation.ban_tags.
+    if (req.method == "BAN" && req.http.%(ban)s) {
+        if (!client.ip ~ purge) {
+            return(synth(405, "Not allowed."));
+        }
+        ban("obj.http.%(tags)s ~ " + req.http.%(ban)s);
+        return(synth(200, "Ban added."));
+    }
+}
+
+sub vcl_deliver {
+    # Tags are only needed for bans
+    unset resp.http.%(tags)s;
+}""" % {"tags": TAGS_HEADER, "ban": TAGS_BAN_HEADER}
+
+TEMPLATE_ESI = """
+sub vcl_recv {
+    # Django only emits ESI includes if the surrogate processes them. See
+    # cache_headers.esi.
+    set req.http.Surrogate-Capability = "varnish=ESI/1.0";
+}
 
+sub vcl_backend_response {
+    # Process the includes of responses marked by the middleware. The header
+    # is removed so the Cache-Control of the page decides whether it is
+    # cached.
+    if (beresp.http.Surrogate-Control ~ "ESI/1.0") {
+        unset beresp.http.Surrogate-Control;
+        set beresp.do_esi = true;
+    }
+}"""
 
 TEMPLATE_A = """
 sub vcl_hash {
@@ -19,51 +51,290 @@ sub vcl_hash {
 
 TEMPLATE_B = """
     set req.http.Hash-Value = "x";
-    if (req.http.Hash-Cookies) {
-        # todo: softcode these checks
-        if (req.http.Hash-Cookies ~ "messages") {
-            if (req.http.Cookie ~ "messages=") {
-                set req.http.Hash-Value = req.http.Hash-Value + regsub(req.http.Cookie, ".*messages=([^;]+).*", "\\1");
-            }
-        }
-        if (req.http.Hash-Cookies == "messages|isauthenticated") {
-            if (req.http.Cookie ~ "isauthenticated=1") {
-                set req.http.Hash-Value = req.http.Hash-Value + "1";
-            }
-        }
-        else if (req.http.Hash-Cookies == "messages|%(sessionid)s") {
-            if (req.http.Cookie ~ "%(sessionid)s=") {
-                set req.http.Hash-Value = req.http.Hash-Value + regsub(req.http.Cookie, ".*%(sessionid)s=([^;]+).*", "\\1");
-            }
-        }
+    if (req.http.Hash-Cookies && req.http.Cookie) {
+%s
     }
 
     hash_data(req.http.Hash-Value);
 
     unset req.http.Hash-Cookies;
     unset req.http.Hash-Value;
-}""" % {"sessionid": settings.SESSION_COOKIE_NAME}
+}"""
+
+
+TEMPLATE_FULL_HEADER = """vcl 4.0;
+
+backend default {
+    .host = "%(host)s";
+    .port = "%(port)s";
+}
+
+acl purge {
+%(acl)s
+}"""
+
+TEMPLATE_FULL_RECV_A = """
+sub vcl_recv {
+    if (req.method == "PURGE") {
+        if (!client.ip ~ purge) {
+            return(synth(405, "Not allowed."));
+        }
+        return(purge);
+    }
+    if (req.method == "BAN") {
+        if (!client.ip ~ purge) {
+            return(synth(405, "Not allowed."));
+        }
+        ban("obj.http.X-Url ~ " + req.http.X-Ban-Url);
+        return(synth(200, "Ban added."));
+    }
+    if (req.method == "PRI") {
+        return(synth(405));
+    }
+    if (req.method != "GET" &&
+      req.method != "HEAD" &&
+      req.method != "PUT" &&
+      req.method != "POST" &&
+      req.method != "TRACE" &&
+      req.method != "OPTIONS" &&
+      req.method != "DELETE") {
+        return(pipe);
+    }
+    if (req.method != "GET" && req.method != "HEAD") {
+        return(pass);
+    }
+    if (req.http.Authorization) {
+        return(pass);
+    }
+
+    # URLs the middleware never caches are passed without a lookup. Cookies
+    # the response cannot depend on are removed."""
+
+TEMPLATE_FULL_RECV_B = """}
+
+sub vcl_backend_response {
+    # Store the URL on the object for lurker friendly bans
+    set beresp.http.X-Url = bereq.url;
+
+    # Cookie is always in Vary but the hash already covers the cookies that
+    # matter
+    set beresp.http.Original-Vary = beresp.http.Vary;
+    set beresp.http.Vary = regsub(beresp.http.Vary, "Cookie", "Substitute");
+
+    if (bereq.uncacheable) {
+        return(deliver);
+    }
+    if (beresp.ttl <= 0s ||
+        beresp.status >= 500 ||
+        beresp.http.Set-Cookie ||
+        beresp.http.Surrogate-control ~ "no-store" ||
+        (!beresp.http.Surrogate-Control &&
+        beresp.http.Cache-Control ~ "no-cache|no-store|private") ||
+        beresp.http.Vary == "*")
+    {
+        # Mark as "Hit-For-Miss" for the next 5 seconds
+        set beresp.ttl = 5s;
+        set beresp.uncacheable = true;
+        return(deliver);
+    }
+
+    # Take the TTL from the rules instead of the response headers"""
+
+TEMPLATE_FULL_BACKEND_RESPONSE_B = """    return(deliver);
+}
+
+sub vcl_deliver {
+    if (obj.hits > 0) {
+        set resp.http.X-Cache = "HIT";
+    } else {
+        set resp.http.X-Cache = "MISS";
+    }
+    set resp.http.Vary = resp.http.Original-Vary;
+    unset resp.http.Original-Vary;
+    unset resp.http.X-Url;
+}"""
 
 
 class Command(BaseCommand):
     help = "Generate a Varnish VCL snippet from the cache headers settings."
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--full", action="store_true",
+            help="Generate a complete VCL instead of a snippet to include."
+        )
+        parser.add_argument(
+            "--cookie-module", action="store_true",
+            help="Parse cookies with vmod_cookie instead of regexes."
+        )
+        parser.add_argument(
+            "--backend", default="127.0.0.1:8080",
+            help="Host and port of the backend for --full."
+        )
+        parser.add_argument(
+            "--purge-acl", nargs="+", default=["localhost", "127.0.0.1"],
+            help="Addresses allowed to purge and ban for --full."
+        )
+
     @transaction.atomic
     def handle(self, *args, **options):
-        request = RequestFactory().get("/")
-        response = HttpResponse()
-        user = User()
-        n = 0
-        print(TEMPLATE_A)
-        for pattern, age, cache_type, dc in rules:
-            policy = POLICIES[cache_type]
-            policy(request, response, user, age)
-            if n == 0:
-                print("if", end="")
-            else:
-                print("else if", end="")
-            print(""" (req.url ~ "%s") {""" % pattern.pattern)
-            print("""set req.http.Hash-Cookies = "%s";""" % response["X-Hash-Cookies"])
-            print("}")
-            n += 1
-        print(TEMPLATE_B)
+        self.rules = middleware.ruleset.rules
+        self.resolver_rules = vcl.resolver_rules(
+            middleware.ruleset.resolver_rules
+        )
+        if options["full"]:
+            host, _, port = options["backend"].rpartition(":")
+            if not (host and port.isdigit()):
+                raise CommandError("--backend must be of the form host:port")
+            self.stdout.write(TEMPLATE_FULL_HEADER % {
+                "host": host,
+                "port": port,
+                "acl": "\n".join(
+                    "    %s;" % vcl.string(a) for a in options["purge_acl"]
+                )
+            })
+        cookie_module = options["cookie_module"]
+        self.stdout.write(TEMPLATE_RECV)
+        self.stdout.write(TEMPLATE_ESI)
+        if cookie_module:
+            self.stdout.write("\nimport cookie;")
+        self.stdout.write(TEMPLATE_A)
+
+        def outcome(rule):
+            return vcl.hash_cookies(POLICIES[rule.cache_type], rule.timeout)
+
+        def body(value):
+            if value is None:
+                return []
+            return ["set req.http.Hash-Cookies = %s;" % vcl.string(value)]
+
+        branches = self.dispatch(outcome)
+        self.stdout.write("\n".join(
+            vcl.chain(branches, "req.url", body, MATCH_PATH_ONLY)
+        ))
+        names = vcl.hash_cookie_names(
+            POLICIES, self.resolver_rules + self.rules
+        )
+        self.stdout.write(TEMPLATE_B % "\n".join(
+            " " * 8 + line for line in vcl.hash_value(names, cookie_module)
+        ))
+        self.write_grace()
+        if options["full"]:
+            self.write_full(cookie_module)
+
+    def dispatch(self, outcome):
+        return vcl.dispatch(
+            self.rules, outcome, MATCH_PATH_ONLY, first=self.resolver_rules
+        )
+
+    def write_grace(self):
+        """Write the grace logic for rules with stale-while-revalidate or
+        stale-if-error. Objects are kept for the longer of the two. While the
+        backend is healthy they are only served stale for the
+        stale-while-revalidate period."""
+
+        def outcome(rule):
+            if rule.stale_while_revalidate or rule.stale_if_error:
+                return rule.stale_while_revalidate, rule.stale_if_error
+            return None
+
+        branches = self.dispatch(outcome)
+        if not branches:
+            return
+
+        def recv(value):
+            if value is None:
+                return []
+            return ["set req.grace = %ds;" % value[0]]
+
+        def backend_response(value):
+            if value is None:
+                return []
+            grace = max(value)
+            # Keep the object past its grace so Varnish can revalidate it
+            # with a conditional request
+            return [
+                "set beresp.grace = %ds;" % grace,
+                "set beresp.keep = %ds;" % grace
+            ]
+
+        self.stdout.write("""
+import std;
+
+sub vcl_recv {
+    if (std.healthy(req.backend_hint)) {""")
+        self.stdout.write("\n".join(vcl.chain(
+            branches, "req.url", recv, MATCH_PATH_ONLY, indent=" " * 8
+        )))
+        self.stdout.write("""    }
+}
+
+sub vcl_backend_response {""")
+        self.stdout.write("\n".join(vcl.chain(
+            branches, "bereq.url", backend_response, MATCH_PATH_ONLY
+        )))
+        self.stdout.write("}")
+
+    def write_full(self, cookie_module=False):
+        """Write the subroutines that make the output a complete VCL. They
+        run after the generated ones above since they return."""
+
+        def recv(rule):
+            if not (rule.timeout or rule.status_timeouts):
+                return "pass"
+            policy = POLICIES[rule.cache_type]
+            # Only content that is the same for all users can do without the
+            # cookies Django needs to identify the user
+            if getattr(policy, "needs_user", True):
+                return "hash"
+            return policy.hash_cookies
+
+        def recv_body(value):
+            if value == "pass":
+                return ["return(pass);"]
+            if value == "hash":
+                return []
+            return vcl.strip_cookies(value, cookie_module)
+
+        self.stdout.write(TEMPLATE_FULL_RECV_A)
+        lines = vcl.chain(
+            self.dispatch(recv), "req.url", recv_body, MATCH_PATH_ONLY
+        )
+        if lines:
+            lines.extend([
+                "    else {",
+                "        return(pass);",
+                "    }",
+                "    return(hash);"
+            ])
+        else:
+            # Nothing is cached
+            lines.append("    return(pass);")
+        self.stdout.write("\n".join(lines))
+        self.stdout.write(TEMPLATE_FULL_RECV_B)
+
+        def ttl(rule):
+            if hasattr(POLICIES[rule.cache_type], "hash_cookies"):
+                statuses = ((200, rule.timeout),) + rule.status_timeouts
+                return tuple((s, t) for s, t in statuses if t) or None
+            # Undeclared policies may set any max-age
+            return None
+
+        def ttl_body(value):
+            if value is None:
+                return []
+            # Only the statuses the middleware caches get the TTL of the rule
+            lines = []
+            for n, (status, timeout) in enumerate(value):
+                lines.extend([
+                    "%s (beresp.status == %d) {"
+                        % ("if" if n == 0 else "} else if", status),
+                    "    set beresp.ttl = %ds;" % timeout
+                ])
+            lines.append("}")
+            return lines
+
+        self.stdout.write("\n".join(vcl.chain(
+            self.dispatch(ttl), "bereq.url", ttl_body, MATCH_PATH_ONLY
+        )))
+        self.stdout.write(TEMPLATE_FULL_BACKEND_RESPONSE_B)
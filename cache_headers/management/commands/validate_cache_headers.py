@@ -0,0 +1,68 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from cache_headers import analysis
+
+
+class Command(BaseCommand):
+    help = "Validate the cache headers rules and report their lookup cost."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--limit", type=float, default=0.05,
+            help="Seconds a single match may take on adversarial input."
+        )
+        parser.add_argument(
+            "--iterations", type=int, default=100,
+            help="Iterations when measuring the lookup cost."
+        )
+
+    def handle(self, *args, **options):
+        try:
+            policies, ruleset = analysis.load()
+        except Exception as exc:
+            raise CommandError("The rules could not be loaded: %s" % exc)
+
+        errors = 0
+        for rule in analysis.unknown_policies(policies, ruleset):
+            errors += 1
+            self.stdout.write("Unknown policy: %s uses %s" % (
+                analysis.describe(rule), rule.cache_type
+            ))
+
+        for rule, by in analysis.shadowed(ruleset.rules):
+            self.stdout.write("Shadowed: %s never applies, %s matches first" % (
+                analysis.describe(rule), analysis.describe(by)
+            ))
+
+        for rule, by, url in analysis.overlaps(ruleset.rules):
+            self.stdout.write("Overlap: %s gets %s instead of %s" % (
+                url, analysis.describe(by), analysis.describe(rule)
+            ))
+
+        for rule in ruleset.rules:
+            result = analysis.backtracking(rule.pattern, options["limit"])
+            if result is not None:
+                errors += 1
+                self.stdout.write(
+                    "Backtracking: %s took %.3fs on %d characters" % (
+                        analysis.describe(rule), result[1], result[0]
+                    )
+                )
+
+        profile = analysis.cost_profile(ruleset, options["iterations"])
+        self.stdout.write(
+            "Rules: %(rules)d patterns, %(resolver_rules)d resolver rules" \
+                % profile
+        )
+        self.stdout.write(
+            "Combined regex: %s" % ("yes" if profile["combined"] else "no")
+        )
+        self.stdout.write(
+            "Uncached lookup: %(mean_resolve_ns)d ns on average, lookup cache "
+            "of %(lookup_cache_size)d paths" % profile
+        )
+        for pattern, ns in profile["slowest"]:
+            self.stdout.write("    %d ns %s" % (ns, pattern))
+
+        if errors:
+            raise CommandError("%d problems found" % errors)
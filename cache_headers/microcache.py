@@ -0,0 +1,281 @@
+"""A response cache in Django for deployments without a reverse cache.
+
+MicroCacheMiddleware stores the responses CacheHeadersMiddleware marks as
+shared cacheable in a Django cache and serves them before the view runs. A
+response is stored under the path and the values of the cookies listed in
+its X-Hash-Cookies header, exactly like the generated VCL hashes it, and of
+the other request headers in its Vary header. Since the cookies and headers
+are only known once a response has been rendered, an index entry per path
+records them.
+
+Optionally concurrent misses for the same path and variant are coalesced so
+only one request renders the response while the others wait for it."""
+
+import hashlib
+import sys
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.cache import cc_delim_re
+from django.utils.deprecation import MiddlewareMixin
+
+from cache_headers.rules import status_timeout
+
+if sys.version_info >= (3, 5):
+    try:
+        from cache_headers.asynchronous import microcache_acall as acall
+    except ImportError:
+        # Django < 3.0 does not ship asgiref
+        acall = None
+else:
+    acall = None
+
+
+try:
+    BACKEND = settings.CACHE_HEADERS["microcache-backend"]
+except (KeyError, AttributeError):
+    BACKEND = "default"
+
+# Responses with larger content are not stored
+try:
+    MAX_SIZE = settings.CACHE_HEADERS["microcache-max-size"]
+except (KeyError, AttributeError):
+    MAX_SIZE = 1024 * 1024
+
+# Let concurrent misses wait for a single render
+try:
+    COALESCE = settings.CACHE_HEADERS["microcache-coalesce"]
+except (KeyError, AttributeError):
+    COALESCE = False
+
+# Seconds a request waits for another one to render the response
+try:
+    COALESCE_TIMEOUT = settings.CACHE_HEADERS["microcache-coalesce-timeout"]
+except (KeyError, AttributeError):
+    COALESCE_TIMEOUT = 10
+
+# Also coalesce across processes with a lock in the cache backend
+try:
+    COALESCE_LOCK = settings.CACHE_HEADERS["microcache-coalesce-lock"]
+except (KeyError, AttributeError):
+    COALESCE_LOCK = False
+
+# Seconds between checks of the cache while another process renders
+POLL_INTERVAL = 0.05
+
+KEY_PREFIX = "dch-micro"
+
+# In-flight renders of this process keyed on the flight key. Values are
+# (event, start) tuples.
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def make_key(kind, version, path, cookies=None):
+    """Return a cache key for the index or a variant of path. Paths are
+    hashed to stay within the key limits of memcached."""
+
+    value = "%s\n%s" % (version, path)
+    if cookies is not None:
+        value += "\n" + "\n".join("%s=%s" % c for c in cookies)
+    return "%s-%s-%s" % (
+        KEY_PREFIX, kind, hashlib.md5(value.encode("utf-8")).hexdigest()
+    )
+
+
+def variant(request, names, headers=()):
+    """Return the (name, value) pairs of the cookies named in names followed
+    by those of the request headers in headers."""
+
+    result = [(name, request.COOKIES.get(name, "")) for name in names]
+    for header in headers:
+        result.append(("header:" + header, request.META.get(
+            "HTTP_" + header.upper().replace("-", "_"), ""
+        )))
+    return result
+
+
+def vary_headers(response):
+    """Return the lowercase names of the request headers other than Cookie
+    the response varies on, or None if it varies on everything. The cookies
+    that matter are listed in X-Hash-Cookies instead."""
+
+    if not response.has_header("Vary"):
+        return []
+    headers = set(
+        h.strip().lower() for h in cc_delim_re.split(response["Vary"])
+        if h.strip()
+    )
+    if "*" in headers:
+        return None
+    headers.discard("cookie")
+    return sorted(headers)
+
+
+class MicroCacheMiddleware(MiddlewareMixin):
+    """Put this middleware before CacheHeadersMiddleware so it sees the
+    headers the policies set. Cache hits are served before the session and
+    authentication middleware run.
+
+    Under ASGI requests wait for another request's render on the event loop,
+    so they do not hold the thread sync views run in."""
+
+    if acall is not None:
+        __acall__ = acall
+
+    def process_request(self, request):
+        response, wait = self.start(request)
+        if wait is not None:
+            response = self.wait(request, wait)
+        return response
+
+    def start(self, request):
+        """Return a (response, wait) tuple. response is the cached response
+        or None. wait is None unless the request should wait for another one
+        to render the response, see coalesce."""
+
+        if request.method != "GET":
+            return None, None
+
+        # Imported here since the middleware module loads the rules
+        from cache_headers.middleware import ruleset
+
+        cache = caches[BACKEND]
+        version = ruleset.version
+        path = request.get_full_path()
+        response = self.get(request, cache, version, path)
+        if (response is not None) or not COALESCE:
+            return response, None
+        return None, self.coalesce(request, cache, version, path)
+
+    def get(self, request, cache, version, path):
+        """Return the cached response to request or None."""
+
+        index = cache.get(make_key("index", version, path))
+        if index is None:
+            return None
+        names, headers = index
+        entry = cache.get(make_key(
+            "variant", version, path, variant(request, names, headers)
+        ))
+        if entry is None:
+            return None
+        response, stored = entry
+        response["Age"] = "%d" % max(0, time.time() - stored)
+        return response
+
+    def coalesce(self, request, cache, version, path):
+        """Return None if the request renders the response itself, otherwise
+        an (event, deadline, version, path) tuple. The request waits until
+        event is set, or if event is None until the response is in the cache,
+        but not past deadline."""
+
+        from cache_headers.middleware import POLICIES, lookup_rule
+
+        # Only URLs that match a pattern rule are coalesced. The URL is not
+        # resolved yet.
+        rule = lookup_rule(request)[0]
+        if (rule is None) or not rule.timeout:
+            return None
+
+        # Requests for different variants must not wait on each other. A
+        # waiter looks the response up under its own variant anyway.
+        policy = POLICIES.get(rule.cache_type)
+        names = getattr(policy, "hash_cookies", None)
+        if names is None:
+            names = sorted(set(
+                name for p in POLICIES.values()
+                for name in getattr(p, "hash_cookies", ())
+            ))
+        key = make_key("flight", version, path, variant(request, names))
+
+        now = time.time()
+        with _flights_lock:
+            flight = _flights.get(key)
+            # A flight older than the timeout is considered abandoned
+            if (flight is None) or (now - flight[1] > COALESCE_TIMEOUT):
+                own = _flights[key] = (threading.Event(), now)
+                flight = None
+        if flight is not None:
+            return flight[0], flight[1] + COALESCE_TIMEOUT, version, path
+
+        # This request leads. Followers are released in process_response.
+        request._dch_flight = (key, own)
+        if not COALESCE_LOCK:
+            return None
+        if cache.add(key, 1, COALESCE_TIMEOUT):
+            request._dch_flight_lock = True
+            return None
+
+        # Another process renders the response
+        return None, now + COALESCE_TIMEOUT, version, path
+
+    def wait(self, request, wait):
+        """Wait as described by the result of coalesce and return the
+        response another request rendered, or None."""
+
+        event, deadline, version, path = wait
+        cache = caches[BACKEND]
+        if event is not None:
+            event.wait(max(0, deadline - time.time()))
+            return self.get(request, cache, version, path)
+        while time.time() < deadline:
+            time.sleep(POLL_INTERVAL)
+            response = self.get(request, cache, version, path)
+            if response is not None:
+                return response
+        return None
+
+    def process_response(self, request, response):
+        try:
+            self.store(request, response)
+        finally:
+            self.land(request)
+        return response
+
+    def store(self, request, response):
+        rule = getattr(request, "_dch_rule", None)
+        if (rule is None) or (request.method != "GET") \
+                or not status_timeout(rule, response.status_code) \
+                or response.streaming \
+                or response.has_header("Set-Cookie") \
+                or response.has_header("Surrogate-Control") \
+                or ("s-maxage" not in response.get("Cache-Control", "")) \
+                or (len(response.content) > MAX_SIZE):
+            return
+        headers = vary_headers(response)
+        if headers is None:
+            return
+
+        from cache_headers.middleware import ruleset
+
+        cache = caches[BACKEND]
+        version = ruleset.version
+        path = request.get_full_path()
+        names = [n for n in response.get("X-Hash-Cookies", "").split("|") if n]
+        cache.set(
+            make_key("index", version, path), (names, headers), rule.timeout
+        )
+        cache.set(
+            make_key(
+                "variant", version, path, variant(request, names, headers)
+            ),
+            (response, time.time()), rule.timeout
+        )
+
+    def land(self, request):
+        """Release the requests waiting for this one."""
+
+        value = getattr(request, "_dch_flight", None)
+        if value is None:
+            return
+        key, flight = value
+        if getattr(request, "_dch_flight_lock", False):
+            caches[BACKEND].delete(key)
+        with _flights_lock:
+            # The flight may have been taken over after a timeout
+            if _flights.get(key) is flight:
+                del _flights[key]
+        flight[0].set()
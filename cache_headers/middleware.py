@@ -1,17 +1,38 @@
+import datetime
 import hashlib
 import logging
-import re
+import sys
+import threading
+import time
 import uuid
-from importlib import import_module
+from timeit import default_timer
 
 from django.conf import settings
-from django.contrib.auth import SESSION_KEY
 from django.contrib.auth.signals import user_logged_in, user_logged_out
-from django.core.cache import cache
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.contrib.messages.storage.fallback import FallbackStorage
+from django.core.exceptions import ImproperlyConfigured
 from django.http import HttpResponseRedirect, HttpResponseBadRequest
+from django.utils.cache import get_conditional_response, patch_vary_headers
 from django.utils.deprecation import MiddlewareMixin
 
-from cache_headers import policies
+from cache_headers import policies, signals
+from cache_headers.esi import SURROGATE_CAPABILITY, SURROGATE_CONTROL
+from cache_headers.providers import get_provider
+from cache_headers.rules import (
+    CACHEABLE_STATUSES, REDIRECT_STATUSES, RuleSet, resolve, status_timeout
+)
+from cache_headers.tags import TAGS_HEADER
+from cache_headers.utils import httpdate, session_key_validator
+
+if sys.version_info >= (3, 5):
+    try:
+        from cache_headers.asynchronous import acall
+    except ImportError:
+        # Django < 3.0 does not ship asgiref
+        acall = None
+else:
+    acall = None
 
 
 # Default policies. Settings may override keys.
@@ -27,19 +48,173 @@ except (KeyError, AttributeError):
     pass
 
 try:
-    TIMEOUTS = settings.CACHE_HEADERS["timeouts"]
+    RULE_PROVIDER = settings.CACHE_HEADERS["rule-provider"]
+except (KeyError, AttributeError):
+    RULE_PROVIDER = None
+
+try:
+    RULES_CHECK_INTERVAL = settings.CACHE_HEADERS["rules-check-interval"]
+except (KeyError, AttributeError):
+    RULES_CHECK_INTERVAL = 0
+
+try:
+    LOOKUP_CACHE_SIZE = settings.CACHE_HEADERS["lookup-cache-size"]
+except (KeyError, AttributeError):
+    LOOKUP_CACHE_SIZE = 1024
+
+try:
+    MATCH_PATH_ONLY = settings.CACHE_HEADERS["match-path-only"]
+except (KeyError, AttributeError):
+    MATCH_PATH_ONLY = False
+
+try:
+    CONDITIONAL_GET = settings.CACHE_HEADERS["enable-conditional-get"]
+except (KeyError, AttributeError):
+    CONDITIONAL_GET = False
+
+try:
+    ENABLE_INSTRUMENTATION = settings.CACHE_HEADERS["enable-instrumentation"]
+except (KeyError, AttributeError):
+    ENABLE_INSTRUMENTATION = False
+
+try:
+    ENABLE_SERVER_TIMING = settings.CACHE_HEADERS["enable-server-timing"]
 except (KeyError, AttributeError):
-    TIMEOUTS = {}
+    ENABLE_SERVER_TIMING = False
+
+# How to keep responses that show messages out of the reverse cache. "redirect"
+# redirects to a unique URL, "private" serves the response as is but marks it
+# as private.
+try:
+    MESSAGES_MODE = settings.CACHE_HEADERS["messages-mode"]
+except (KeyError, AttributeError):
+    MESSAGES_MODE = "redirect"
+
+# Timing is only done if anything consumes it
+INSTRUMENT = ENABLE_INSTRUMENTATION or ENABLE_SERVER_TIMING
 
-# Build a flat list of rules
+provider = get_provider(RULE_PROVIDER)
+ruleset = None
+# The pattern rules of the current rule set, kept for code written against
+# earlier versions. Their first fields are the (regex, timeout, cache_type,
+# length) tuples of those versions.
 rules = []
-for cache_type in TIMEOUTS.keys():
-    for timeout, strings in TIMEOUTS[cache_type].items():
-        for s in strings:
-            rules.append((re.compile(r"" + s), timeout, cache_type, len(s)))
+_reload_lock = threading.Lock()
+_next_check = 0
+
+
+def reload_rules(force=False):
+    """Load the rules from the provider and swap in a new rule set if their
+    version changed, or always if force is set. Return True if the rules were
+    swapped. Rules that refer to an unknown policy raise ImproperlyConfigured
+    and are not swapped in.
+
+    The rule set is replaced with a single assignment. Requests in flight
+    finish with the rule set they started with."""
+
+    global ruleset, rules
+    with _reload_lock:
+        if (not force) and (ruleset is not None) \
+                and (provider.version() == ruleset.version):
+            return False
+        version, timeouts = provider.load()
+        new = RuleSet(timeouts, version, MATCH_PATH_ONLY, LOOKUP_CACHE_SIZE)
+        # A typo in the rules would fail every request the rule matches
+        unknown = set(
+            rule.cache_type
+            for rules in (new.rules, new.resolver_rules.values())
+            for rule in rules if rule.cache_type not in POLICIES
+        )
+        if unknown:
+            raise ImproperlyConfigured(
+                "Unknown cache policies: %s" % ", ".join(sorted(unknown))
+            )
+        # Precompute the headers of the declared policies for every rule
+        policies.clear_bundles()
+        policies.precompute(POLICIES, new.rules)
+        policies.precompute(POLICIES, new.resolver_rules.values())
+        ruleset = new
+        rules = new.rules
+    return True
+
+
+def rules_due():
+    """Return True if the check interval has passed and start the next
+    one."""
 
-# Sort from longest string to shortest
-rules.sort(key=lambda x: x[3], reverse=True)
+    global _next_check
+    now = time.time()
+    if now < _next_check:
+        return False
+    _next_check = now + RULES_CHECK_INTERVAL
+    return True
+
+
+def refresh_rules():
+    """Reload the rules if they changed. Errors are logged and the current
+    rules stay in place. Providers may do blocking I/O or query the
+    database, so under ASGI this runs in a thread."""
+
+    try:
+        reload_rules()
+    except Exception:
+        logging.getLogger("django").exception("Could not reload cache rules")
+
+
+def poll_rules():
+    """Reload the rules if they changed and the check interval has
+    passed."""
+
+    if rules_due():
+        refresh_rules()
+
+
+def on_rules_changed(sender, **kwargs):
+    reload_rules(force=True)
+
+signals.rules_changed.connect(on_rules_changed)
+
+# Build the rule set once. Errors in the rules surface at startup.
+reload_rules()
+
+
+def lookup_rule(request):
+    """Return a (rule, hit) tuple where rule is the rule that applies to the
+    request or None and hit indicates whether the lookup was served from the
+    lookup cache. Rules for views are only found once the URL is resolved."""
+
+    if RULES_CHECK_INTERVAL:
+        poll_rules()
+
+    # Use the same rule set for the whole lookup
+    current = ruleset
+
+    # Rules for views are a dictionary lookup on the resolver match.
+    # Patterns are the fallback.
+    match = getattr(request, "resolver_match", None)
+    if match is not None:
+        rule = resolve(current.resolver_rules, match)
+        if rule is not None:
+            return rule, True
+
+    if current.query_matcher is None:
+        return current.matcher.lookup(request.get_full_path())
+
+    rule, hit = current.matcher.lookup(request.path_info)
+    query_string = request.META.get("QUERY_STRING", "")
+    if current.query_matcher.rules and query_string:
+        query_rule, query_hit = current.query_matcher.lookup(
+            "%s?%s" % (request.path_info, query_string)
+        )
+        hit = hit and query_hit
+        if (query_rule is not None) \
+            and ((rule is None) or (query_rule.length >= rule.length)):
+            rule = query_rule
+    return rule, hit
+
+
+# Resolve the session engine once
+validate_session_key = session_key_validator(settings.SESSION_ENGINE)
 
 # Subscribe to signals so we can mark the request
 def on_user_auth_event(sender, user, request, **kwargs):
@@ -51,18 +226,96 @@ user_logged_out.connect(on_user_auth_event)
 
 class CacheHeadersMiddleware(MiddlewareMixin):
     """Put this middleware before authentication middleware because response
-    runs in reverse order."""
+    runs in reverse order.
+
+    Under ASGI the middleware runs natively async. Only responses whose policy
+    needs the user or session are processed in a thread."""
+
+    sync_capable = True
+    async_capable = True
+
+    if acall is not None:
+        __acall__ = acall
+
+    def lookup(self, request):
+        """Return a (rule, hit) tuple where rule is the rule that applies to
+        the request or None and hit indicates whether the lookup was served
+        from the lookup cache."""
+
+        return lookup_rule(request)
+
+    def match(self, request):
+        """Return the rule that applies to the request or None."""
+
+        return self.lookup(request)[0]
 
     def process_response(self, request, response):
+        if INSTRUMENT:
+            start = default_timer()
+            return self.report(request, self.handle(request, response), start)
+        return self.handle(request, response)
+
+    def handle(self, request, response):
+        response, rule = self.resolve(request, response)
+        if rule is None:
+            return response
+        return self.apply(request, response, rule)
+
+    def report(self, request, response, start):
+        """Send the cache_decision signal and set the Server-Timing and debug
+        headers for a response processed since start."""
+
+        elapsed_ns = int((default_timer() - start) * 1e9)
+        rule, hit = getattr(request, "_dch_lookup", (None, None))
+        pattern = policy = None
+        age = 0
+        if rule is not None:
+            if rule.pattern is None:
+                pattern = rule.name
+            else:
+                pattern = rule.pattern.pattern
+            policy = rule.cache_type
+            age = rule.timeout
+
+        if ENABLE_INSTRUMENTATION:
+            signals.cache_decision.send(
+                sender=self.__class__, request=request, response=response,
+                path=request.get_full_path(), pattern=pattern, policy=policy,
+                age=age, lookup_hit=hit, elapsed_ns=elapsed_ns
+            )
+
+        if ENABLE_SERVER_TIMING:
+            response["Server-Timing"] = "dch;dur=%.3f" % (elapsed_ns / 1e6)
+            if rule is not None:
+                response["X-Cache-Headers-Rule"] = "%s; policy=%s; age=%d; lookup=%s" \
+                    % (pattern, policy, age, "hit" if hit else "miss")
+
+        return response
+
+    def resolve(self, request, response):
+        """Return a (response, rule) tuple. If rule is None the response is
+        final, otherwise the rule's policy must still be applied.
+
+        Apart from login and logout requests this step never touches the user
+        or the session, so it is safe to run on an event loop."""
+
+        # The reverse cache must process the ESI of the response whether the
+        # response is cached or not
+        if getattr(request, "_dch_esi", False):
+            response["Surrogate-Control"] = SURROGATE_CONTROL
+        if getattr(request, "_dch_vary_surrogate", False):
+            patch_vary_headers(response, (SURROGATE_CAPABILITY,))
 
         # Do not interfere in debug mode
         if settings.DEBUG:
-            return response
+            return response, None
 
-        # If there is no user on the request then do nothing
+        # If there is no user on the request then do nothing. The user is
+        # usually a lazy object and evaluating it loads the session and queries
+        # the database, so only test for its presence here.
         user = getattr(request, "user", None)
-        if not user:
-            return response
+        if user is None:
+            return response, None
 
         # Set or delete isauthenticated cookie
         if hasattr(request, "_dch_auth_event"):
@@ -77,18 +330,32 @@ class CacheHeadersMiddleware(MiddlewareMixin):
 
         # If cache control was set at the start of this method then do nothing
         if ("Cache-Control" in response) or ("cache-control" in response):
-            return response
+            return response, None
 
-        # Do nothing if response code is not 200
-        if response.status_code != 200:
-            return response
+        # Do nothing if response code is not 200, unless the rule sets a
+        # timeout for the status
+        found = None
+        status = response.status_code
+        if status != 200:
+            if status not in CACHEABLE_STATUSES:
+                return response, None
+            found = self.lookup(request)
+            if (found[0] is None) or not status_timeout(found[0], status):
+                return response, None
+            if (status in REDIRECT_STATUSES) \
+                    and self.session_specific_redirect(request, response):
+                return response, None
 
         # Default policy is to not cache
         response["Cache-Control"] = "no-cache"
 
         # During login and logout we do not cache
         if hasattr(request, "_dch_auth_event"):
-            return response
+            return response, None
+
+        # Fragments rendered in place may depend on the user
+        if getattr(request, "_dch_esi_inline", False):
+            return response, None
 
         # We use the sessionid in Varnish rules to determine whether as user is
         # authenticated or not. Check for a valid session to prevent cache
@@ -97,16 +364,91 @@ class CacheHeadersMiddleware(MiddlewareMixin):
             cookie = request.COOKIES[settings.SESSION_COOKIE_NAME]
             sessionid = getattr(cookie, "value", cookie)
             if sessionid:
-                store = import_module(settings.SESSION_ENGINE).SessionStore(SESSION_KEY)
-                if not store._validate_session_key(sessionid):
+                if not validate_session_key(sessionid):
                     return HttpResponseBadRequest(
                         "User has an invalid sessionid"
-                    )
+                    ), None
+
+        # Never cache non-GET
+        if request.method.lower() not in ("get", "head"):
+            return response, None
+
+        # Don't cache if response sets cookies
+        if response.has_header("Set-Cookie"):
+            logger = logging.getLogger("django")
+            logger.warn(
+                "Attempting to cache path %s but Set-Cookie is on the response" \
+                    % request.get_full_path()
+            )
+            return response, None
+
+        # Determine age and policy. The matcher memoizes lookups in-process.
+        rule, hit = found or self.lookup(request)
+        if INSTRUMENT:
+            request._dch_lookup = (rule, hit)
+        age = 0 if rule is None else status_timeout(rule, status)
+        if not age:
+            return response, None
+
+        # Policies and the microcache take the age from the rule
+        if age != rule.timeout:
+            rule = rule._replace(timeout=age)
+
+        return response, rule
 
-        # Check more tampering
-        if getattr(settings, "CACHE_HEADERS", {}).get(
+    def session_specific_redirect(self, request, response):
+        """Return True if the target of a redirect may depend on the session,
+        ie. the session was read while producing it or the Location contains
+        the session key. Reading the flag does not load the session."""
+
+        session = getattr(request, "session", None)
+        if getattr(session, "accessed", False):
+            return True
+        location = response.get("Location", "")
+        sessionid = request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+        return bool(sessionid) and (sessionid in location)
+
+    def needs_identity(self, request, rule):
+        """Return True if applying the rule may evaluate the user or load the
+        session, ie. it may block on the database or session store."""
+
+        policy = POLICIES[rule.cache_type]
+
+        # Custom policies may do anything
+        if not hasattr(policy, "hash_cookies"):
+            return True
+
+        if policy.cache_anonymous != policy.cache_authenticated:
+            return True
+
+        if policy.needs_user and getattr(settings, "CACHE_HEADERS", {}).get(
             "enable-tampering-checks", False
         ):
+            return True
+
+        # Messages are read from the cookie first and only fall back to the
+        # session when the cookie says there are more.
+        storage = getattr(request, "_messages", None)
+        if (storage is None) or isinstance(storage, CookieStorage):
+            return False
+        if isinstance(storage, FallbackStorage):
+            return CookieStorage.cookie_name in request.COOKIES
+        return True
+
+    def apply(self, request, response, rule):
+        """Apply the rule's policy to the response and return the response."""
+
+        user = request.user
+        age = rule.timeout
+        policy = POLICIES[rule.cache_type]
+
+        # Check more tampering. This is only relevant for responses that may
+        # end up in a shared cache and whose cached variant depends on the
+        # user. Policies that do not need the user never evaluate it.
+        if getattr(policy, "needs_user", True) \
+            and getattr(settings, "CACHE_HEADERS", {}).get(
+                "enable-tampering-checks", False
+            ):
             if user.is_anonymous:
                 value = request.COOKIES.get("isauthenticated", None)
                 if value not in (None, ""):
@@ -121,62 +463,70 @@ class CacheHeadersMiddleware(MiddlewareMixin):
                         "User is authenticated, but did not send valid isauthenticated cookie"
                     )
 
-        # Never cache non-GET
-        if request.method.lower() not in ("get", "head"):
+        # If request contains messages adjust url so it busts reverse cache,
+        # or in private mode serve the messages without caching them. This
+        # applies only to paths that would otherwise be cached.
+        pth = request.get_full_path()
+        # Return if already marked
+        if (MESSAGES_MODE == "redirect") and ("dch-uuid=" in pth):
             return response
+        l = 0
+        try:
+            l = len(request._messages)
+        except (AttributeError, TypeError):
+            pass
+        if l:
+            if MESSAGES_MODE == "private":
+                response["Cache-Control"] = "private, no-store"
+                return response
+            # Only a page can be served again under another URL
+            if response.status_code != 200:
+                return response
+            if "?" in pth:
+                pth += "&dch-uuid="
+            else:
+                pth += "?dch-uuid="
+            pth += str(uuid.uuid1())
+            return HttpResponseRedirect(pth)
 
-        # Don't cache if response sets cookies
-        if response.has_header("Set-Cookie"):
-            logger = logging.getLogger("django")
-            logger.warn(
-                "Attempting to cache path %s but Set-Cookie is on the response" \
-                    % request.get_full_path()
-            )
-            return response
+        # The user is handed over lazily, so policies that do not depend on
+        # the identity of the user never cause it to be evaluated.
+        request._dch_rule = rule
+        policy(request, response, user, age)
 
-        # Determine age and policy. Use cached lookups.
-        full_path = request.get_full_path()
-        key = "dch-%s" % hashlib.md5(full_path.encode("utf-8")).hexdigest()
-        cached = cache.get(key, None)
-        if cached is not None:
-            age = cached["age"]
-            cache_type = cached["cache_type"]
-        else:
-            age = 0
-            cache_type = None
-            for pattern, timeout, cache_type, _ in rules:
-                if pattern.match(full_path):
-                    age = timeout
-                    break
-
-            # We can cache this for a long time because settings can't change
-            # during the process lifetime.
-            cache.set(key, {"age": age, "cache_type": cache_type}, 86400)
-
-        # If request contains messages adjust url so it busts reverse cache.
-        # This applies only to paths that would otherwise be cached.
-        if age and request:
-            pth = full_path
-            # Return if already marked
-            if "dch-uuid=" in pth:
-                return response
-            l = 0
-            try:
-                l = len(request._messages)
-            except (AttributeError, TypeError):
-                pass
-            if l:
-                if "?" in pth:
-                    pth += "&dch-uuid="
-                else:
-                    pth += "?dch-uuid="
-                pth += str(uuid.uuid1())
-                return HttpResponseRedirect(pth)
+        # Policies set Vary themselves
+        if getattr(request, "_dch_vary_surrogate", False):
+            patch_vary_headers(response, (SURROGATE_CAPABILITY,))
+
+        # Tags registered while rendering let the reverse cache ban exactly
+        # the pages that show an object.
+        tags = getattr(request, "_dch_tags", None)
+        if tags:
+            response[TAGS_HEADER] = " ".join(sorted(tags))
 
-        if age:
-            policy = POLICIES[cache_type]
-            policy(request, response, user, age)
-        else:
-            response["Cache-Control"] = "no-cache"
+        # Policies only set Last-Modified on responses they allow to be cached
+        if CONDITIONAL_GET and response.has_header("Last-Modified"):
+            return self.conditional_response(request, response, age)
 
         return response
+
+    def conditional_response(self, request, response, age):
+        """Return a 304 Not Modified response if the client holds a fresh copy
+        of the response, otherwise return the response itself.
+
+        Last-Modified is set to the start of the current cache window so it is
+        stable for the duration of the window. A weak ETag is computed from
+        the content of non-streaming responses."""
+
+        now = int(time.time())
+        last_modified = now - now % age
+        response["Last-Modified"] = httpdate(
+            datetime.datetime.utcfromtimestamp(last_modified)
+        )
+        etag = response.get("ETag", None)
+        if (etag is None) and not response.streaming:
+            etag = 'W/"%s"' % hashlib.md5(response.content).hexdigest()
+            response["ETag"] = etag
+        return get_conditional_response(
+            request, etag=etag, last_modified=last_modified, response=response
+        )
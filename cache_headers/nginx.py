@@ -0,0 +1,159 @@
+"""Helpers to translate the rules into nginx configuration.
+
+nginx tests the regexes of a map in the order they appear, so the branches
+built by vcl.dispatch translate directly into map blocks. A map tests a
+single variable. In path only mode consecutive branches that test the path
+and the full URL therefore go into separate maps that fall back on each
+other."""
+
+import re
+
+from django.contrib.auth.models import User
+from django.http import HttpResponse
+from django.test.client import RequestFactory
+from django.utils.cache import cc_delim_re
+
+from cache_headers import policies
+
+
+# Cookies whose name can be used in a $cookie_ variable
+COOKIE_VARIABLE = re.compile(r"^\w+$")
+
+# The URL without the query string, the way the generated VCL strips it
+PATH_MAP = [
+    "map $request_uri $dch_path {",
+    '    "~^(?<dch_path_only>[^?]*)" $dch_path_only;',
+    "}"
+]
+
+# Cookie is always in Vary, but the cache key already covers the cookies that
+# matter, so Vary is ignored. Compressed and uncompressed responses are kept
+# apart instead.
+ACCEPT_ENCODING_MAP = [
+    "map $http_accept_encoding $dch_accept_encoding {",
+    '    default "";',
+    '    "~*gzip" "gzip";',
+    "}"
+]
+
+# nginx does not process ESI, but a client announcing it gets the shell of
+# pages with fragments, so those are kept apart too. See esi.supports_esi.
+SURROGATE_CAPABILITY_MAP = [
+    "map $http_surrogate_capability $dch_esi {",
+    '    default "";',
+    '    "~ESI/1\\\\.0" "esi";',
+    "}"
+]
+
+
+def string(value):
+    """Return value as a quoted nginx string. Backslashes are escaped since
+    the nginx parser unescapes them in quoted strings."""
+
+    return '"%s"' % value.replace("\\", "\\\\").replace('"', '\\"')
+
+
+def maps(branches, variable, value, default, path_only=False):
+    """Return the lines of the map blocks that set variable to the value of
+    the first matching branch, or to default. value is a callable returning
+    the nginx value of a branch and default an nginx value."""
+
+    runs = []
+    for branch in branches:
+        if runs and (runs[-1][0] == branch[2]):
+            runs[-1][1].append(branch)
+        else:
+            runs.append((branch[2], [branch]))
+    if not runs:
+        runs.append((False, []))
+
+    lines = []
+    for n, (query_aware, run) in enumerate(runs):
+        name = variable if n == 0 else "%s_%d" % (variable, n + 1)
+        if n + 1 < len(runs):
+            fallback = "$%s_%d" % (variable, n + 2)
+        else:
+            fallback = default
+        subject = "$dch_path" if (path_only and not query_aware) \
+            else "$request_uri"
+        lines.append("map %s $%s {" % (subject, name))
+        lines.append("    default %s;" % fallback)
+        for regex, branch_value, branch_query_aware in run:
+            lines.append(
+                "    %s %s;" % (string("~" + regex), value(branch_value))
+            )
+        lines.append("}")
+    return lines
+
+
+def vary_headers(policy, age):
+    """Return the lowercase names of the request headers a policy varies
+    on, except those the cache key covers anyway. See ACCEPT_ENCODING_MAP,
+    SURROGATE_CAPABILITY_MAP and hash_value."""
+
+    if hasattr(policy, "hash_cookies"):
+        value = policies.VARY
+    else:
+        # Undeclared policies have to be called to find out
+        response = HttpResponse()
+        policy(RequestFactory().get("/"), response, User(), age)
+        value = response.get("Vary", "")
+    return [
+        header for header in (
+            h.strip().lower() for h in cc_delim_re.split(value)
+        )
+        if header and header not in (
+            "accept-encoding", "cookie", "surrogate-capability"
+        )
+    ]
+
+
+def vary_value(headers):
+    """Return the value that adds the request headers to the cache key."""
+
+    return "".join(
+        ";%s=$http_%s" % (header, header.replace("-", "_"))
+        for header in headers
+    )
+
+
+def cookie_variables(names):
+    """Return a (lines, variables) tuple. variables maps every cookie name to
+    the variable holding its value and lines are the maps needed for names
+    nginx has no $cookie_ variable for."""
+
+    lines = []
+    variables = {}
+    for name in names:
+        if COOKIE_VARIABLE.match(name):
+            variables[name] = "$cookie_%s" % name
+            continue
+        variable = "dch_cookie_%d" % (len(variables) + 1)
+        lines.extend([
+            "map $http_cookie $%s {" % variable,
+            '    default "";',
+            '    %s $dch_cookie_value;'
+                % string("~(?:^|;\\s*)%s=(?<dch_cookie_value>[^;]*)"
+                         % re.escape(name)),
+            "}"
+        ])
+        variables[name] = "$" + variable
+    return lines, variables
+
+
+def hash_value(values, variables):
+    """Return the lines of the map that sets $dch_hash_value to the values of
+    the cookies listed in $dch_hash_cookies. values are the distinct
+    Hash-Cookies values, names joined by |."""
+
+    lines = [
+        "map $dch_hash_cookies $dch_hash_value {",
+        '    default "";'
+    ]
+    for value in values:
+        lines.append("    %s %s;" % (string(value), string("".join(
+            ";%s=%s" % (name, variables[name]) for name in value.split("|")
+            if name
+        ))))
+    lines.append("}")
+    return lines
@@ -1,8 +1,6 @@
-import datetime
-
 from django.conf import settings
 
-from cache_headers.utils import httpdate
+from cache_headers.utils import httpdate_now
 
 
 try:
@@ -15,56 +13,144 @@ except (KeyError, AttributeError):
 # accidental shared caching of per-user content. Our sample Varnish
 # configuration file is smart enough to omit Cookie from the Vary header when
 # computing the hash.
+VARY = "Accept-Encoding,Cookie"
+
+# Header bundles keyed on (policy, age, authenticated, stale)
+_bundles = {}
+
+
+def declare(hash_cookies, anonymous=True, authenticated=True, needs_user=True):
+    """Decorator that declares how a policy caches content.
+
+    hash_cookies is the sequence of cookies the reverse cache hashes on.
+    anonymous and authenticated indicate whether content may be cached for
+    those users. needs_user declares whether the cached variant depends on the
+    identity of the user. The middleware avoids evaluating the lazy user, and
+    with it loading the session and querying the database, for policies that
+    set it to False. Custom policies without the attribute are assumed to need
+    it."""
+
+    def decorator(func):
+        func.hash_cookies = tuple(hash_cookies)
+        func.cache_anonymous = anonymous
+        func.cache_authenticated = authenticated
+        func.needs_user = needs_user
+        return func
+
+    return decorator
+
+
+def header_bundle(policy, age, authenticated, stale=(0, 0)):
+    """Return a (headers, cacheable) tuple for a declared policy. headers is a
+    tuple of (name, value) pairs. Only Last-Modified is left to be set per
+    response.
+
+    stale is a (stale-while-revalidate, stale-if-error) tuple in seconds."""
+
+    key = (policy, age, authenticated, stale)
+    try:
+        return _bundles[key]
+    except KeyError:
+        pass
+
+    if authenticated:
+        cacheable = policy.cache_authenticated
+    else:
+        cacheable = policy.cache_anonymous
+    if cacheable:
+        cache_control = "max-age=%d, s-maxage=%d" % (browser_cache_seconds, age)
+        if stale[0]:
+            cache_control += ", stale-while-revalidate=%d" % stale[0]
+        if stale[1]:
+            cache_control += ", stale-if-error=%d" % stale[1]
+        headers = (
+            # nginx specific but safe to set in all cases
+            ("X-Accel-Expires", "%d" % age),
+            ("Cache-Control", cache_control),
+        )
+    else:
+        headers = (("Cache-Control", "no-cache"),)
+    headers += (
+        ("X-Hash-Cookies", "|".join(policy.hash_cookies)),
+        ("Vary", VARY)
+    )
+
+    bundle = (headers, cacheable)
+    _bundles[key] = bundle
+    return bundle
 
+
+def clear_bundles():
+    """Forget the header bundles of rules that may no longer exist."""
+
+    _bundles.clear()
+
+
+def precompute(policies, rules):
+    """Compute the header bundles of declared policies for all rules and the
+    timeouts they set per status."""
+
+    for rule in rules:
+        policy = policies.get(rule.cache_type)
+        if hasattr(policy, "hash_cookies"):
+            ages = [rule.timeout] + [t for s, t in rule.status_timeouts]
+            for age in ages:
+                for authenticated in (False, True):
+                    header_bundle(
+                        policy, age, authenticated, stale_times(rule)
+                    )
+
+
+def stale_times(rule):
+    if rule is None:
+        return (0, 0)
+    return (rule.stale_while_revalidate, rule.stale_if_error)
+
+
+def apply_policy(policy, request, response, user, age):
+    """Set the headers of a declared policy on the response. The user is only
+    evaluated if the policy treats anonymous and authenticated users
+    differently. Stale times are taken from the rule the middleware matched
+    for the request."""
+
+    authenticated = False
+    if policy.cache_anonymous != policy.cache_authenticated:
+        authenticated = user.is_authenticated
+    headers, cacheable = header_bundle(
+        policy, age, authenticated,
+        stale_times(getattr(request, "_dch_rule", None))
+    )
+    for name, value in headers:
+        response[name] = value
+    if cacheable:
+        response["Last-Modified"] = httpdate_now()
+
+
+@declare(hash_cookies=("messages",), needs_user=False)
 def all_users(request, response, user, age):
     """Content is cached once for all users."""
 
-    response["Last-Modified"] = httpdate(datetime.datetime.utcnow())
-    # nginx specific but safe to set in all cases
-    response["X-Accel-Expires"] = age
-    response["Cache-Control"] = "max-age=%d, s-maxage=%d" \
-        % (browser_cache_seconds, age)
-    response["X-Hash-Cookies"] = "messages"
-    response["Vary"] = "Accept-Encoding,Cookie"
+    apply_policy(all_users, request, response, user, age)
 
 
+@declare(hash_cookies=("messages", "isauthenticated"), authenticated=False)
 def anonymous_only(request, response, user, age):
     """Content is cached once only for anonymous users."""
 
-    if user.is_anonymous:
-        response["Last-Modified"] = httpdate(datetime.datetime.utcnow())
-        # nginx specific but safe to set in all cases
-        response["X-Accel-Expires"] = age
-        response["Cache-Control"] = "max-age=%d, s-maxage=%d" \
-            % (browser_cache_seconds, age)
-    else:
-        response["Cache-Control"] = "no-cache"
-
-    response["X-Hash-Cookies"] = "messages|isauthenticated"
-    response["Vary"] = "Accept-Encoding,Cookie"
+    apply_policy(anonymous_only, request, response, user, age)
 
 
+@declare(hash_cookies=("messages", "isauthenticated"))
 def anonymous_and_authenticated(request, response, user, age):
     """Content is cached once for anonymous users and once for authenticated
     users."""
 
-    response["Last-Modified"] = httpdate(datetime.datetime.utcnow())
-    # nginx specific but safe to set in all cases
-    response["X-Accel-Expires"] = age
-    response["Cache-Control"] = "max-age=%d, s-maxage=%d" \
-        % (browser_cache_seconds, age)
-    response["X-Hash-Cookies"] = "messages|isauthenticated"
-    response["Vary"] = "Accept-Encoding,Cookie"
+    apply_policy(anonymous_and_authenticated, request, response, user, age)
 
 
+@declare(hash_cookies=("messages", settings.SESSION_COOKIE_NAME))
 def per_user(request, response, user, age):
     """Content is cached once for anonymous users and for each authenticated
     user individually."""
 
-    response["Last-Modified"] = httpdate(datetime.datetime.utcnow())
-    # nginx specific but safe to set in all cases
-    response["X-Accel-Expires"] = age
-    response["Cache-Control"] = "max-age=%d, s-maxage=%d" \
-        % (browser_cache_seconds, age)
-    response["X-Hash-Cookies"] = "messages|%s" % settings.SESSION_COOKIE_NAME
-    response["Vary"] = "Accept-Encoding,Cookie"
+    apply_policy(per_user, request, response, user, age)
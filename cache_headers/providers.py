@@ -0,0 +1,91 @@
+"""Rule providers supply the timeouts to the middleware.
+
+A provider has two methods. version() returns a value that changes whenever
+the rules change and is called every time the middleware polls for changes,
+so it must be cheap. load() returns a (version, timeouts) tuple where
+timeouts has the format of the timeouts setting."""
+
+import json
+import os
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+from cache_headers.rules import RESOLVER_KEYS
+
+
+class SettingsProvider(object):
+    """Provide the timeouts setting. Settings can't change while the process
+    runs so the version never changes."""
+
+    def version(self):
+        return "settings"
+
+    def load(self):
+        try:
+            timeouts = settings.CACHE_HEADERS["timeouts"]
+        except (KeyError, AttributeError):
+            timeouts = {}
+        return self.version(), timeouts
+
+
+class FileProvider(object):
+    """Provide the timeouts from a JSON file, or a YAML file if the name ends
+    with .yml or .yaml. YAML requires PyYAML. Timeouts may be strings since
+    JSON keys always are."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def version(self):
+        stat = os.stat(self.path)
+        return "%s-%s" % (stat.st_mtime, stat.st_size)
+
+    def load(self):
+        # Take the version first. If the file changes while it is read the
+        # next poll loads it again.
+        version = self.version()
+        with open(self.path) as fp:
+            if self.path.endswith((".yml", ".yaml")):
+                try:
+                    import yaml
+                except ImportError:
+                    raise ImproperlyConfigured(
+                        "PyYAML is required to load rules from %s" % self.path
+                    )
+                data = yaml.safe_load(fp)
+            else:
+                data = json.load(fp)
+        return version, normalize(data or {})
+
+
+def normalize(timeouts):
+    """Return timeouts with integer timeouts and tuples of patterns, URL
+    names, namespaces and views."""
+
+    result = {}
+    for cache_type, values in timeouts.items():
+        result[cache_type] = {}
+        for timeout, value in values.items():
+            if isinstance(value, dict):
+                value = dict(value, patterns=tuple(value.get("patterns", ())))
+                for key, kind in RESOLVER_KEYS:
+                    if key in value:
+                        value[key] = tuple(value[key])
+            else:
+                value = tuple(value)
+            result[cache_type][int(timeout)] = value
+    return result
+
+
+def get_provider(value):
+    """Return a provider for the rule-provider setting. It is either None for
+    the settings, a provider instance or the dotted path to a provider class
+    that takes no arguments."""
+
+    if value is None:
+        return SettingsProvider()
+    if hasattr(value, "load"):
+        return value
+    return import_string(value)()
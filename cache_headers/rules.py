@@ -0,0 +1,241 @@
+import re
+from collections import namedtuple
+
+from django.core.exceptions import ImproperlyConfigured
+
+from cache_headers.utils import LRUCache
+
+
+# Rules that are resolved from the resolver match instead of a pattern have a
+# pattern of None and a name describing what they match. status_timeouts is
+# a sorted tuple of (status, timeout) pairs for responses other than 200.
+Rule = namedtuple("Rule", (
+    "pattern", "timeout", "cache_type", "length", "stale_while_revalidate",
+    "stale_if_error", "name", "status_timeouts"
+))
+Rule.__new__.__defaults__ = (0, 0, None, ())
+
+# Statuses other than 200 a rule may set a timeout for. Server errors are
+# never cached.
+CACHEABLE_STATUSES = (
+    203, 204, 300, 301, 302, 303, 307, 308, 404, 405, 410, 414
+)
+REDIRECT_STATUSES = (300, 301, 302, 303, 307, 308)
+
+# Keys of a timeout that select views through the resolver match, mapped to
+# the prefix of the rule name
+RESOLVER_KEYS = (
+    ("url-names", "url-name"),
+    ("namespaces", "namespace"),
+    ("views", "view"),
+)
+
+# Constructs that change meaning when a pattern is embedded in a larger
+# alternation: numbered or named backreferences, conditionals and inline flags
+# which older Pythons apply to the whole expression.
+UNSAFE_TO_COMBINE = re.compile(r"\\[1-9]|\(\?P=|\(\?\(|\(\?[aiLmsux]+\)")
+
+# A pattern that explicitly matches a literal question mark is assumed to be
+# written against the query string.
+QUERY_AWARE = re.compile(r"\\\?|\[\?\]")
+
+_MISSING = object()
+
+
+def build_rules(timeouts):
+    """Flatten the timeouts setting into a list of rules, ordered from longest
+    pattern to shortest.
+
+    A timeout maps to either a sequence of patterns or a dictionary with the
+    patterns under the "patterns" key and optional "stale-while-revalidate"
+    and "stale-if-error" values in seconds. "status-timeouts" maps response
+    statuses other than 200 to their timeout, see CACHEABLE_STATUSES. See
+    build_resolver_rules for the other keys of the dictionary."""
+
+    rules = []
+    for cache_type in timeouts.keys():
+        for timeout, value in timeouts[cache_type].items():
+            if isinstance(value, dict):
+                strings = value.get("patterns", ())
+                stale_while_revalidate = value.get("stale-while-revalidate", 0)
+                stale_if_error = value.get("stale-if-error", 0)
+                statuses = parse_status_timeouts(
+                    value.get("status-timeouts", {})
+                )
+            else:
+                strings = value
+                stale_while_revalidate = stale_if_error = 0
+                statuses = ()
+            for s in strings:
+                rules.append(Rule(
+                    re.compile(r"" + s), timeout, cache_type, len(s),
+                    stale_while_revalidate, stale_if_error, None, statuses
+                ))
+
+    # Sort from longest string to shortest
+    rules.sort(key=lambda x: x[3], reverse=True)
+    return rules
+
+
+def build_resolver_rules(timeouts):
+    """Return a dictionary of the rules that select views by URL name,
+    namespace or the dotted path of the view. Keys are (kind, value) tuples
+    where kind is one of "url-name", "namespace" or "view".
+
+    These are listed in a timeout dictionary under the "url-names",
+    "namespaces" and "views" keys. URL names include their namespaces, eg.
+    "blog:detail"."""
+
+    rules = {}
+    for cache_type in timeouts.keys():
+        for timeout, value in timeouts[cache_type].items():
+            if not isinstance(value, dict):
+                continue
+            for key, kind in RESOLVER_KEYS:
+                for name in value.get(key, ()):
+                    rules[(kind, name)] = Rule(
+                        None, timeout, cache_type, 0,
+                        value.get("stale-while-revalidate", 0),
+                        value.get("stale-if-error", 0),
+                        "%s:%s" % (kind, name),
+                        parse_status_timeouts(value.get("status-timeouts", {}))
+                    )
+    return rules
+
+
+def parse_status_timeouts(value):
+    """Return a dictionary of timeouts keyed on status as a sorted tuple of
+    (status, timeout) pairs. Statuses may be strings since JSON keys always
+    are."""
+
+    result = []
+    for status, timeout in value.items():
+        status = int(status)
+        if status not in CACHEABLE_STATUSES:
+            raise ImproperlyConfigured(
+                "Responses with status %d can not be cached" % status
+            )
+        result.append((status, int(timeout)))
+    return tuple(sorted(result))
+
+
+def status_timeout(rule, status):
+    """Return the timeout of the rule for a response status, 0 if responses
+    with the status are not cached."""
+
+    if status == 200:
+        return rule.timeout
+    for value, timeout in rule.status_timeouts:
+        if value == status:
+            return timeout
+    return 0
+
+
+def resolve(resolver_rules, match):
+    """Return the rule for a resolver match or None. A rule set by the
+    cache_policy decorator wins, followed by the URL name, the innermost
+    namespace and the view."""
+
+    rule = getattr(match.func, "_dch_rule", None)
+    if (rule is not None) or not resolver_rules:
+        return rule
+    rule = resolver_rules.get(("url-name", match.view_name))
+    if rule is not None:
+        return rule
+    namespaces = match.namespaces
+    for n in range(len(namespaces), 0, -1):
+        rule = resolver_rules.get(("namespace", ":".join(namespaces[:n])))
+        if rule is not None:
+            return rule
+    return resolver_rules.get(("view", match._func_path))
+
+
+def is_query_aware(rule):
+    return QUERY_AWARE.search(rule.pattern.pattern) is not None
+
+
+class RuleMatcher(object):
+    """Resolve a path to the first matching rule.
+
+    All rules are merged into a single compiled alternation so a lookup is one
+    regex evaluation instead of one per rule. Results are memoized in a bounded
+    in-process LRU so repeated paths never touch the regex engine at all."""
+
+    def __init__(self, rules, max_entries=1024):
+        self.rules = list(rules)
+        self.cache = LRUCache(max_entries)
+        self.combined = self._combine(self.rules)
+
+    @staticmethod
+    def _combine(rules):
+        if not rules:
+            return None
+        for rule in rules:
+            if UNSAFE_TO_COMBINE.search(rule.pattern.pattern):
+                return None
+        try:
+            return re.compile("|".join(
+                "(?P<dch%d>%s)" % (n, rule.pattern.pattern)
+                for n, rule in enumerate(rules)
+            ))
+        except (re.error, AssertionError, OverflowError):
+            # Too many groups or otherwise uncombinable. Fall back to trying
+            # the rules one by one.
+            return None
+
+    def _resolve(self, path):
+        if self.combined is not None:
+            # Alternatives are tried left to right so the first rule that
+            # matches wins, exactly as with a linear scan. The outermost group
+            # closes last, so lastgroup always names the rule.
+            match = self.combined.match(path)
+            if match is None:
+                return None
+            return self.rules[int(match.lastgroup[3:])]
+        for rule in self.rules:
+            if rule.pattern.match(path):
+                return rule
+        return None
+
+    def lookup(self, path):
+        """Return a (rule, hit) tuple where rule is the first rule matching
+        path or None and hit indicates whether it came from the LRU."""
+
+        rule = self.cache.get(path, _MISSING)
+        if rule is _MISSING:
+            rule = self._resolve(path)
+            self.cache.set(path, rule)
+            return rule, False
+        return rule, True
+
+    def match(self, path):
+        """Return the first rule matching path or None."""
+
+        return self.lookup(path)[0]
+
+
+class RuleSet(object):
+    """A version of the rules with its matchers. A rule set is not changed
+    once built so it can replace another in a single assignment. Every rule
+    set has its own lookup caches, so decisions of an older version are never
+    served after a swap.
+
+    In path only mode rules that refer to the query string get a matcher of
+    their own so that arbitrary query strings do not churn the main lookup
+    cache."""
+
+    def __init__(self, timeouts, version=None, path_only=False,
+                 max_entries=1024):
+        self.version = version
+        self.rules = build_rules(timeouts)
+        self.resolver_rules = build_resolver_rules(timeouts)
+        if path_only:
+            self.matcher = RuleMatcher(
+                [r for r in self.rules if not is_query_aware(r)], max_entries
+            )
+            self.query_matcher = RuleMatcher(
+                [r for r in self.rules if is_query_aware(r)], max_entries
+            )
+        else:
+            self.matcher = RuleMatcher(self.rules, max_entries)
+            self.query_matcher = None
@@ -0,0 +1,13 @@
+from django.dispatch import Signal
+
+
+# Sent by CacheHeadersMiddleware for every response when the
+# enable-instrumentation setting is set. Arguments are request, response, path,
+# pattern, policy, age, lookup_hit and elapsed_ns. pattern, policy and
+# lookup_hit are None if no rule was looked up for the response.
+cache_decision = Signal()
+
+# Send to have CacheHeadersMiddleware reload its rules from the rule provider,
+# eg. after the rules in the database changed. Only the current process
+# reloads.
+rules_changed = Signal()
@@ -0,0 +1,36 @@
+"""Tag responses with the objects they were rendered from so the reverse
+cache can ban exactly the pages that show an object. See
+cache_headers.invalidation.ban_tags."""
+
+from django.conf import settings
+
+
+try:
+    TAGS_HEADER = settings.CACHE_HEADERS["tags-header"]
+except (KeyError, AttributeError):
+    TAGS_HEADER = "xkey"
+
+
+def object_tag(obj):
+    """Return the tag of a model instance, eg. auth.user-1."""
+
+    return "%s.%s-%s" % (obj._meta.app_label, obj._meta.model_name, obj.pk)
+
+
+def to_tags(items):
+    """Yield tags for a sequence of strings and model instances."""
+
+    for item in items:
+        if hasattr(item, "_meta"):
+            yield object_tag(item)
+        else:
+            yield str(item)
+
+
+def add_cache_tags(request, *items):
+    """Tag the response to request with strings or model instances."""
+
+    tags = getattr(request, "_dch_tags", None)
+    if tags is None:
+        tags = request._dch_tags = set()
+    tags.update(to_tags(items))
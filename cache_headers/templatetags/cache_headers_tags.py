@@ -0,0 +1,27 @@
+from django import template
+
+from cache_headers import esi
+from cache_headers.tags import add_cache_tags
+
+
+register = template.Library()
+
+
+@register.simple_tag(takes_context=True)
+def cache_tags(context, *items):
+    """Tag the response with strings or model instances, eg.
+    {% cache_tags object "news" %}. Requires the request in the context."""
+
+    request = context.get("request", None)
+    if request is not None:
+        add_cache_tags(request, *items)
+    return ""
+
+
+@register.simple_tag(takes_context=True)
+def esi_include(context, name, *args, **kwargs):
+    """Include a fragment through ESI, eg. {% esi_include "account:header" %}.
+    name is a path or a URL name reversed with the arguments. Requires the
+    request in the context."""
+
+    return esi.include(context["request"], name, *args, **kwargs)
@@ -0,0 +1,30 @@
+import asyncio
+
+
+def run_async_middleware(middleware_class, request, response):
+    """Run the request through an instance of middleware_class wrapping an
+    async view that returns response."""
+
+    async def get_response(request):
+        return response
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(middleware_class(get_response)(request))
+    finally:
+        loop.close()
+
+
+def get_concurrently_async(path, count):
+    """Return the responses to count concurrent requests for path made
+    through the ASGI handler."""
+
+    from asgiref.sync import async_to_sync
+    from django.test import AsyncClient
+
+    async def get():
+        return await asyncio.gather(
+            *[AsyncClient().get(path) for n in range(count)]
+        )
+
+    return async_to_sync(get)()
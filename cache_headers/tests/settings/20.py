@@ -15,7 +15,7 @@ TEMPLATE_DEBUG = DEBUG
 DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
-        "NAME": "cache_headers.db"
+        "NAME": ":memory:"
     }
 }
 
@@ -71,7 +71,12 @@ CACHE_HEADERS = {
         "all-users": {
             600: (
                 "^/all-users/",
-            )
+            ),
+            300: {
+                "patterns": ("^/stale/",),
+                "stale-while-revalidate": 30,
+                "stale-if-error": 3600
+            }
         },
         "anonymous-only": {
             600: (
@@ -0,0 +1,90 @@
+import re
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from django.core.management import CommandError, call_command
+from django.test import SimpleTestCase
+
+from cache_headers import analysis, middleware
+from cache_headers.checks import check_rules
+from cache_headers.rules import RuleSet, build_rules
+
+
+TIMEOUTS = {
+    "all-users": {
+        60: ("^/news/", "^/about/$", "^/shop/"),
+        600: ("^/news/archive/",)
+    },
+    "per-user": {
+        30: ("^/(news|about)/.*", "^/.*/feed/")
+    }
+}
+
+
+class AnalysisTest(SimpleTestCase):
+
+    def describe(self, items):
+        return [tuple(analysis.describe(r) for r in item) for item in items]
+
+    def test_shadowed(self):
+        rules = build_rules(TIMEOUTS)
+        self.assertEqual(
+            self.describe(analysis.shadowed(rules)),
+            [("^/about/$", "^/(news|about)/.*")]
+        )
+
+    def test_overlaps(self):
+        rules = build_rules(TIMEOUTS)
+        found = dict(
+            (analysis.describe(rule), (analysis.describe(by), url))
+            for rule, by, url in analysis.overlaps(rules)
+        )
+        self.assertEqual(found["^/news/"], ("^/(news|about)/.*", "/news/"))
+        self.assertEqual(found["^/shop/"], ("^/.*/feed/", "/shop/feed/"))
+        self.assertNotIn("^/about/$", found)
+
+    def test_backtracking(self):
+        self.assertIsNotNone(
+            analysis.backtracking(re.compile(r"^/(a+)+$"), limit=0.01)
+        )
+        self.assertIsNone(analysis.backtracking(re.compile(r"^/news/")))
+
+    def test_cost_profile(self):
+        profile = analysis.cost_profile(RuleSet(TIMEOUTS), iterations=2)
+        self.assertEqual(profile["rules"], 6)
+        self.assertTrue(profile["combined"])
+        self.assertEqual(len(profile["slowest"]), 5)
+
+
+class ValidationTest(SimpleTestCase):
+
+    def setUp(self):
+        super(ValidationTest, self).setUp()
+        self.saved = middleware.ruleset
+
+    def tearDown(self):
+        middleware.ruleset = self.saved
+        super(ValidationTest, self).tearDown()
+
+    def test_check(self):
+        self.assertEqual(check_rules(None), [])
+        middleware.ruleset = RuleSet(dict(TIMEOUTS, missing={60: ("^/x/",)}))
+        self.assertEqual(
+            sorted(m.id for m in check_rules(None)),
+            ["cache_headers.E002", "cache_headers.W001"]
+        )
+
+    def test_command(self):
+        out = StringIO()
+        call_command("validate_cache_headers", iterations=2, stdout=out)
+        self.assertIn("Combined regex: yes", out.getvalue())
+
+        middleware.ruleset = RuleSet(dict(TIMEOUTS, missing={60: ("^/x/",)}))
+        out = StringIO()
+        with self.assertRaises(CommandError):
+            call_command("validate_cache_headers", iterations=2, stdout=out)
+        self.assertIn("Unknown policy: ^/x/ uses missing", out.getvalue())
+        self.assertIn("Shadowed: ^/about/$", out.getvalue())
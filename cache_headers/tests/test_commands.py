@@ -0,0 +1,264 @@
+import json
+import re
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from django.http.response import HttpResponse
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.test.utils import captured_stdout
+from django.urls import resolve
+
+from cache_headers import middleware, vcl
+from cache_headers.rules import RuleSet
+from cache_headers.tests import test_nginx
+
+
+class BenchmarkCommandTest(TestCase):
+
+    def test_benchmark(self):
+        out = StringIO()
+        call_command(
+            "benchmark_cache_headers", rules=[10], iterations=20, paths=5,
+            caches=["none", "locmem"], stdout=out
+        )
+        results = json.loads(out.getvalue())
+        self.assertEqual(len(results), 16)
+        self.assertEqual(
+            sorted(set(r["microcache"] for r in results)), ["locmem", "none"]
+        )
+        for result in results:
+            self.assertEqual(result["rules"], 10)
+            self.assertEqual(result["lookup_cache"]["misses"], 5)
+            self.assertTrue(result["mean_ns"] > 0)
+
+
+class GenerateVCLCommandTest(TestCase):
+
+    def test_grace(self):
+        with captured_stdout() as out:
+            call_command("generate_vcl")
+        vcl = out.getvalue()
+        self.assertIn("set req.grace = 30s;", vcl)
+        self.assertIn("set beresp.grace = 3600s;", vcl)
+
+    def test_esi(self):
+        with captured_stdout() as out:
+            call_command("generate_vcl")
+        vcl = out.getvalue()
+        self.assertIn('set req.http.Surrogate-Capability = "varnish=ESI/1.0";', vcl)
+        self.assertIn("set beresp.do_esi = true;", vcl)
+
+    def test_full(self):
+        with captured_stdout() as out:
+            call_command("generate_vcl", full=True, backend="10.0.0.1:8000")
+        vcl = out.getvalue()
+        self.assertTrue(vcl.startswith("vcl 4.0;"))
+        self.assertIn('.host = "10.0.0.1";', vcl)
+        recv = vcl[vcl.rindex("sub vcl_recv"):vcl.rindex("return(hash);")]
+        # Only all-users content loses its cookies
+        self.assertIn(
+            'else if (req.url ~ "^(?:^/all-users/|^/stale/)") {\n'
+            '        set req.http.Cookie = ";" + req.http.Cookie;',
+            recv
+        )
+        self.assertEqual(recv.count("req.http.Cookie = \";\""), 1)
+        self.assertIn("else {\n        return(pass);", recv)
+        self.assertIn("set beresp.ttl = 300s;", vcl)
+
+    def test_status_timeouts(self):
+        saved = middleware.ruleset
+        middleware.ruleset = RuleSet({"all-users": {
+            600: {"patterns": ("^/news/",), "status-timeouts": {404: 60}},
+            0: {"patterns": ("^/gone/",), "status-timeouts": {410: 3600}}
+        }})
+        try:
+            with captured_stdout() as out:
+                call_command("generate_vcl", full=True)
+        finally:
+            middleware.ruleset = saved
+        vcl = out.getvalue()
+
+        # A rule that only caches other statuses is not passed
+        recv = vcl[vcl.rindex("sub vcl_recv"):vcl.rindex("return(hash);")]
+        for regex, body in re.findall(
+            r'if \(req\.url ~ "([^"]*)"\) \{\n((?:        .*\n)*)    \}', recv
+        ):
+            if re.search(regex, "/gone/"):
+                self.assertNotIn("return(pass);", body)
+                break
+        else:
+            self.fail("No branch for /gone/")
+        self.assertIn(
+            "if (beresp.status == 410) {\n"
+            "            set beresp.ttl = 3600s;",
+            vcl
+        )
+        self.assertIn(
+            "if (beresp.status == 200) {\n"
+            "            set beresp.ttl = 600s;\n"
+            "        } else if (beresp.status == 404) {\n"
+            "            set beresp.ttl = 60s;\n"
+            "        }",
+            vcl
+        )
+        # Server errors are never cached
+        self.assertIn("beresp.status >= 500 ||", vcl)
+
+    def test_full_without_rules(self):
+        saved = middleware.ruleset, vcl.url_patterns
+        middleware.ruleset = RuleSet({})
+        vcl.url_patterns = lambda: iter(())
+        try:
+            with captured_stdout() as out:
+                call_command("generate_vcl", full=True)
+        finally:
+            middleware.ruleset, vcl.url_patterns = saved
+        output = out.getvalue()
+        recv = output[output.rindex("sub vcl_recv"):]
+        recv = recv[:recv.index("\n}\n")]
+        self.assertTrue(recv.endswith("\n    return(pass);"))
+        self.assertNotIn("else", recv)
+
+    def test_cookie_module(self):
+        with captured_stdout() as out:
+            call_command("generate_vcl", full=True, cookie_module=True)
+        vcl = out.getvalue()
+        self.assertIn("import cookie;", vcl)
+        self.assertIn('cookie.get("isauthenticated")', vcl)
+        self.assertIn('cookie.keep("messages");', vcl)
+        self.assertNotIn("regsub(req.http.Cookie", vcl)
+
+    def test_full_backend(self):
+        with self.assertRaises(CommandError):
+            call_command("generate_vcl", full=True, backend="localhost")
+
+    def test_hash_cookies(self):
+        with captured_stdout() as out:
+            call_command("generate_vcl")
+        vcl = out.getvalue()
+        sub = vcl[vcl.index("sub vcl_hash"):vcl.index("set req.http.Hash-Value")]
+        branches = re.findall(
+            r'if \(req\.url ~ "([^"]*)"\) \{\n(?:\s*set req\.http\.Hash-Cookies = "([^"]*)";)?',
+            sub
+        )
+        self.assertTrue(branches)
+        for path in (
+            "/all-users/", "/stale/1/", "/anonymous-only/", "/per-user/x/",
+            "/anonymous-and-authenticated/", "/other/", "/x/all-users/"
+        ):
+            expected = None
+            rule = middleware.ruleset.matcher.match(path)
+            if rule is not None:
+                response = HttpResponse()
+                middleware.POLICIES[rule.cache_type](
+                    RequestFactory().get(path), response, User(), rule.timeout
+                )
+                expected = response.get("X-Hash-Cookies")
+            found = None
+            for regex, cookies in branches:
+                if re.search(regex, path):
+                    found = cookies or None
+                    break
+            self.assertEqual(found, expected, path)
+
+
+class GenerateNginxCommandTest(TestCase):
+
+    def test_hash_cookies(self):
+        out = StringIO()
+        call_command("generate_nginx", zone="django", stdout=out)
+        config = out.getvalue()
+        self.assertIn("proxy_cache django;", config)
+        blocks = test_nginx.parse(config.splitlines())
+        for path in (
+            "/all-users/", "/stale/1/", "/anonymous-only/", "/per-user/x/",
+            "/decorated/", "/other/", "/x/all-users/"
+        ):
+            rule = middleware.ruleset.matcher.match(path)
+            if path == "/decorated/":
+                rule = resolve(path).func._dch_rule
+            expected = ""
+            if rule is not None:
+                response = HttpResponse()
+                middleware.POLICIES[rule.cache_type](
+                    RequestFactory().get(path), response, User(), rule.timeout
+                )
+                expected = "".join(
+                    ";%s=%s" % (name, name.upper())
+                    for name in response["X-Hash-Cookies"].split("|")
+                )
+            values = dict(
+                ("cookie_%s" % name, name.upper())
+                for name in ("messages", "isauthenticated", "sessionid")
+            )
+            values["request_uri"] = path
+            self.assertEqual(
+                test_nginx.lookup(blocks, "dch_hash_value", values),
+                expected, path
+            )
+            self.assertEqual(
+                test_nginx.lookup(blocks, "dch_bypass", values),
+                "1" if rule is None else "0", path
+            )
+
+    def test_vary(self):
+        # Vary is ignored, so the request headers the policies vary on are
+        # part of the key
+        out = StringIO()
+        call_command("generate_nginx", stdout=out)
+        config = out.getvalue()
+        self.assertIn("$dch_vary_value", re.search(
+            r"proxy_cache_key (.*);", config
+        ).group(1))
+        blocks = test_nginx.parse(config.splitlines())
+        values = {"http_x_is_special_user": "1"}
+        for path, expected in (
+            ("/custom-policy/", ";x-is-special-user=1"), ("/all-users/", ""),
+            ("/other/", "")
+        ):
+            values["request_uri"] = path
+            self.assertEqual(
+                test_nginx.lookup(blocks, "dch_vary_value", values),
+                expected, path
+            )
+
+    def test_surrogate_capability(self):
+        # Clients announcing ESI get the shell of pages with fragments
+        out = StringIO()
+        call_command("generate_nginx", stdout=out)
+        config = out.getvalue()
+        self.assertIn("$dch_esi", re.search(
+            r"proxy_cache_key (.*);", config
+        ).group(1))
+        blocks = test_nginx.parse(config.splitlines())
+        for capability, expected in (
+            ("", ""), ("varnish=ESI/1.0", "esi"), ("x=ESI/100", "")
+        ):
+            self.assertEqual(test_nginx.lookup(
+                blocks, "dch_esi", {"http_surrogate_capability": capability}
+            ), expected, capability)
+
+    def test_status_timeouts(self):
+        saved = middleware.ruleset
+        middleware.ruleset = RuleSet({"all-users": {
+            0: {"patterns": ("^/gone/",), "status-timeouts": {410: 3600}},
+            60: ("^/news/",)
+        }, "per-user": {0: ("^/account/",)}})
+        out = StringIO()
+        try:
+            call_command("generate_nginx", stdout=out)
+        finally:
+            middleware.ruleset = saved
+        blocks = test_nginx.parse(out.getvalue().splitlines())
+        for path, bypass in (
+            ("/gone/", "0"), ("/news/", "0"), ("/account/", "1")
+        ):
+            self.assertEqual(test_nginx.lookup(
+                blocks, "dch_bypass", {"request_uri": path}
+            ), bypass, path)
@@ -0,0 +1,57 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.test import TestCase
+from django.urls import reverse_lazy
+
+from cache_headers.tests.test_microcache import MICROCACHE
+
+
+esi = reverse_lazy("esi")
+greeting = reverse_lazy("greeting")
+
+
+class ESITest(TestCase):
+
+    def setUp(self):
+        super(ESITest, self).setUp()
+        user = get_user_model().objects.create(username="esi")
+        self.client.force_login(user)
+
+    def test_include(self):
+        response = self.client.get(
+            esi, HTTP_SURROGATE_CAPABILITY="varnish=ESI/1.0"
+        )
+        self.assertContains(
+            response, '<esi:include src="%s"/>' % greeting
+        )
+        self.assertEqual(response["Surrogate-Control"], 'content="ESI/1.0"')
+        self.assertIn("Surrogate-Capability", response["Vary"])
+
+        # The shell is cached once for all users and the fragment per user
+        self.assertEqual(response["Cache-Control"], "max-age=100, s-maxage=600")
+        self.assertEqual(response["X-Hash-Cookies"], "messages")
+        response = self.client.get(greeting)
+        self.assertEqual(
+            response["X-Hash-Cookies"],
+            "messages|%s" % settings.SESSION_COOKIE_NAME
+        )
+
+    def test_inline(self):
+        # Without a surrogate that processes ESI the fragment is rendered in
+        # place, so the page is not cached
+        response = self.client.get(esi)
+        self.assertContains(response, "<header>Hello esi</header>")
+        self.assertEqual(response["Cache-Control"], "no-cache")
+        self.assertFalse(response.has_header("Surrogate-Control"))
+        self.assertIn("Surrogate-Capability", response["Vary"])
+
+    def test_microcache(self):
+        # The shell rendered for a surrogate is never served to a client that
+        # cannot process it
+        caches["default"].clear()
+        with self.settings(**MICROCACHE):
+            self.client.get(esi, HTTP_SURROGATE_CAPABILITY="varnish=ESI/1.0")
+            response = self.client.get(esi)
+            self.assertNotContains(response, "<esi:include")
+            self.assertContains(response, "<header>Hello esi</header>")
@@ -0,0 +1,175 @@
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_delete, post_save
+from django.db import transaction
+from django.test import TransactionTestCase
+
+from cache_headers import invalidation
+
+
+class VarnishStub(ThreadingMixIn, HTTPServer):
+    """Records the requests it receives and the client ports they came
+    from."""
+
+    daemon_threads = True
+
+    def __init__(self):
+        self.received = []
+        self.ports = set()
+        HTTPServer.__init__(self, ("127.0.0.1", 0), VarnishStubHandler)
+
+
+class VarnishStubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def handle_request(self):
+        self.server.received.append(
+            (
+                self.command, self.path,
+                self.headers.get("X-Ban-Url") or self.headers.get("X-Ban-Tags")
+            )
+        )
+        self.server.ports.add(self.client_address[1])
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    do_PURGE = do_BAN = handle_request
+
+    def log_message(self, *args):
+        pass
+
+
+class InvalidationTest(TransactionTestCase):
+
+    def setUp(self):
+        super(InvalidationTest, self).setUp()
+        self.stub = VarnishStub()
+        thread = threading.Thread(target=self.stub.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.saved = invalidation.dispatcher
+        invalidation.dispatcher = invalidation.Dispatcher(
+            ["http://127.0.0.1:%d" % self.stub.server_port], interval=0.05
+        )
+
+    def tearDown(self):
+        invalidation.dispatcher.close()
+        invalidation.dispatcher = self.saved
+        self.stub.shutdown()
+        self.stub.server_close()
+        super(InvalidationTest, self).tearDown()
+
+    def test_batch(self):
+        requests = invalidation.dispatcher.batch([
+            ("PURGE", None, "/a/"), ("BAN", "X-Ban-Url", "^/b/"),
+            ("PURGE", None, "/a/"), ("BAN", "X-Ban-Url", "^/c/"),
+            ("BAN", "X-Ban-Url", "^/b/")
+        ])
+        self.assertEqual(requests, [
+            ("PURGE", None, "/a/"), ("BAN", "X-Ban-Url", "(?:^/b/)|(?:^/c/)")
+        ])
+
+    def test_escape(self):
+        # Only regex metacharacters are escaped, on every Python version
+        self.assertEqual(
+            invalidation.escape("/a-b/c.html?x=[1]"),
+            "/a-b/c\\.html\\?x=\\[1\\]"
+        )
+
+    def test_collect(self):
+        dispatcher = invalidation.Dispatcher(
+            ["http://127.0.0.1:1"], interval=0.05, max_wait=0.2, max_items=3
+        )
+        for n in range(5):
+            dispatcher._queue.put(("PURGE", None, "/%d/" % n))
+        self.assertEqual(len(dispatcher.collect()), 3)
+        self.assertEqual(len(dispatcher.collect()), 2)
+
+        # A steady stream is sent once the first item waited max_wait
+        stop = threading.Event()
+
+        def feed():
+            while not stop.wait(0.01):
+                dispatcher._queue.put(("PURGE", None, "/"))
+
+        thread = threading.Thread(target=feed)
+        thread.start()
+        try:
+            start = time.time()
+            dispatcher.max_items = 1000
+            dispatcher.collect()
+            self.assertTrue(time.time() - start < 0.5)
+        finally:
+            stop.set()
+            thread.join()
+
+    def test_dispatch(self):
+        invalidation.purge("http://example.com/a/?page=1")
+        invalidation.purge("http://example.com/a/?page=1")
+        invalidation.ban("^/b/")
+        invalidation.ban_url("/c/")
+        invalidation.dispatcher.flush()
+        self.assertEqual(self.stub.received, [
+            ("PURGE", "/a/?page=1", None),
+            ("BAN", "/", "(?:^/b/)|(?:^/c/(\\?|$))")
+        ])
+
+        invalidation.ban("^/d/")
+        invalidation.dispatcher.flush()
+        self.assertEqual(self.stub.received[-1], ("BAN", "/", "^/d/"))
+
+        # All requests went over one connection
+        self.assertEqual(len(self.stub.ports), 1)
+
+    def test_register(self):
+        model = get_user_model()
+        invalidation.register(
+            model, lambda user: ["/users/%s/" % user.username]
+        )
+        try:
+            user = model.objects.create(username="joe")
+            user.delete()
+
+            # Nothing is banned for changes that are rolled back
+            try:
+                with transaction.atomic():
+                    model.objects.create(username="jane")
+                    raise ValueError
+            except ValueError:
+                pass
+            invalidation.dispatcher.flush()
+        finally:
+            uid = "cache-headers-%s.%s" \
+                % (model._meta.app_label, model._meta.model_name)
+            post_save.disconnect(sender=model, dispatch_uid=uid)
+            post_delete.disconnect(sender=model, dispatch_uid=uid)
+        self.assertEqual(
+            self.stub.received, [("BAN", "/", "^/users/joe/(\\?|$)")]
+        )
+
+    def test_tags(self):
+        model = get_user_model()
+        invalidation.register_tags(model)
+        try:
+            user = model.objects.create(username="joe")
+            invalidation.ban_tags("news", "news")
+            invalidation.dispatcher.flush()
+        finally:
+            uid = "cache-headers-tags-%s.%s" \
+                % (model._meta.app_label, model._meta.model_name)
+            post_save.disconnect(sender=model, dispatch_uid=uid)
+            post_delete.disconnect(sender=model, dispatch_uid=uid)
+        self.assertEqual(self.stub.received, [(
+            "BAN", "/",
+            "(?:(^|\\s)(auth\\.user-%s)(\\s|$))|(?:(^|\\s)(news)(\\s|$))" % user.pk
+        )])
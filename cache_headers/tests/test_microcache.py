@@ -0,0 +1,205 @@
+import sys
+import threading
+import time
+from unittest import skipIf
+
+import django
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.test import TestCase
+from django.urls import reverse_lazy
+
+from cache_headers import microcache, middleware
+from cache_headers.rules import RuleSet
+from cache_headers.tests import views
+
+if sys.version_info >= (3, 5):
+    from cache_headers.tests.asynchronous import get_concurrently_async
+
+
+all_users = reverse_lazy("all-users")
+per_user = reverse_lazy("per-user")
+home = reverse_lazy("home")
+slow = reverse_lazy("slow")
+
+# Django 1.11 is tested with MIDDLEWARE_CLASSES
+if settings.MIDDLEWARE is not None:
+    MIDDLEWARE_SETTING = "MIDDLEWARE"
+else:
+    MIDDLEWARE_SETTING = "MIDDLEWARE_CLASSES"
+
+# Settings that put the microcache in front of the other middleware
+MICROCACHE = {MIDDLEWARE_SETTING: (
+    "cache_headers.microcache.MicroCacheMiddleware",
+) + tuple(getattr(settings, MIDDLEWARE_SETTING))}
+
+
+class MicroCacheTest(TestCase):
+
+    def setUp(self):
+        super(MicroCacheTest, self).setUp()
+        caches["default"].clear()
+
+    def test_hit(self):
+        with self.settings(**MICROCACHE):
+            response = self.client.get(all_users)
+            self.assertFalse(response.has_header("Age"))
+            response = self.client.get(all_users)
+            self.assertTrue(response.has_header("Age"))
+            self.assertEqual(
+                response["Cache-Control"], "max-age=100, s-maxage=600"
+            )
+
+            # The query string is part of the key
+            response = self.client.get(all_users, {"page": 2})
+            self.assertFalse(response.has_header("Age"))
+
+    def test_variants(self):
+        with self.settings(**MICROCACHE):
+            user = get_user_model().objects.create(username="micro")
+            self.client.force_login(user)
+            self.client.get(per_user)
+            response = self.client.get(per_user)
+            self.assertTrue(response.has_header("Age"))
+
+            # Another session is another variant
+            client = self.client_class()
+            client.force_login(user)
+            response = client.get(per_user)
+            self.assertFalse(response.has_header("Age"))
+
+            # Cookies the policy does not hash on do not matter
+            self.client.cookies["other"] = "1"
+            self.client.get(all_users)
+            self.client.cookies["other"] = "2"
+            response = self.client.get(all_users)
+            self.assertTrue(response.has_header("Age"))
+
+    def test_vary(self):
+        # Request headers in Vary other than Cookie select a variant
+        with self.settings(**MICROCACHE):
+            self.client.get(all_users, HTTP_ACCEPT_ENCODING="gzip")
+            response = self.client.get(all_users)
+            self.assertFalse(response.has_header("Age"))
+            response = self.client.get(all_users, HTTP_ACCEPT_ENCODING="gzip")
+            self.assertTrue(response.has_header("Age"))
+
+    def test_not_cacheable(self):
+        with self.settings(**MICROCACHE):
+            self.client.get(home)
+            response = self.client.get(home)
+            self.assertFalse(response.has_header("Age"))
+            self.assertEqual(response["Cache-Control"], "no-cache")
+
+    def test_rules_version(self):
+        saved = middleware.ruleset
+        try:
+            with self.settings(**MICROCACHE):
+                self.client.get(all_users)
+                middleware.ruleset = RuleSet(
+                    {"all-users": {60: ("^/all-users/",)}}, version="2"
+                )
+                response = self.client.get(all_users)
+                self.assertFalse(response.has_header("Age"))
+                self.assertEqual(
+                    response["Cache-Control"], "max-age=100, s-maxage=60"
+                )
+        finally:
+            middleware.ruleset = saved
+
+
+class CoalesceTest(TestCase):
+
+    def setUp(self):
+        super(CoalesceTest, self).setUp()
+        caches["default"].clear()
+        del views.renders[:]
+        self.saved = (
+            microcache.COALESCE, microcache.COALESCE_TIMEOUT,
+            microcache.COALESCE_LOCK
+        )
+        microcache.COALESCE = True
+
+    def tearDown(self):
+        (
+            microcache.COALESCE, microcache.COALESCE_TIMEOUT,
+            microcache.COALESCE_LOCK
+        ) = self.saved
+        microcache._flights.clear()
+        super(CoalesceTest, self).tearDown()
+
+    def get_concurrently(self, count):
+        responses = []
+
+        def get():
+            responses.append(self.client_class().get(slow))
+
+        threads = [threading.Thread(target=get) for n in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return responses
+
+    def test_single_render(self):
+        with self.settings(**MICROCACHE):
+            responses = self.get_concurrently(4)
+        self.assertEqual(len(views.renders), 1)
+        self.assertEqual([r.status_code for r in responses], [200] * 4)
+        self.assertEqual(
+            sorted(r.has_header("Age") for r in responses),
+            [False, True, True, True]
+        )
+
+    @skipIf(django.VERSION < (3, 1), "Async middleware requires Django 3.1")
+    def test_asgi(self):
+        # Waiting must not block the thread the slow view renders in
+        microcache.COALESCE_TIMEOUT = 2
+        with self.settings(**MICROCACHE):
+            start = time.time()
+            responses = get_concurrently_async(str(slow), 3)
+        self.assertTrue(time.time() - start < 1)
+        self.assertEqual(len(views.renders), 1)
+        self.assertEqual(
+            sorted(r.has_header("Age") for r in responses),
+            [False, True, True]
+        )
+
+    def test_timeout(self):
+        # A render that never finishes only delays the others
+        microcache.COALESCE_TIMEOUT = 0.1
+        with self.settings(**MICROCACHE):
+            key = microcache.make_key(
+                "flight", middleware.ruleset.version, str(slow),
+                [("messages", "")]
+            )
+            microcache._flights[key] = (threading.Event(), time.time())
+            start = time.time()
+            response = self.client.get(slow)
+        self.assertTrue(time.time() - start >= 0.1)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(views.renders), 1)
+
+    def test_lock(self):
+        microcache.COALESCE_TIMEOUT = 0.1
+        microcache.COALESCE_LOCK = True
+        with self.settings(**MICROCACHE):
+            key = microcache.make_key(
+                "flight", middleware.ruleset.version, str(slow),
+                [("messages", "")]
+            )
+            # Another process holds the lock
+            caches["default"].add(key, 1)
+            response = self.client.get(slow)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(views.renders), 1)
+
+            # The lock of this process is released after the render
+            caches["default"].clear()
+            self.client.get(str(slow) + "?page=2")
+            self.assertIsNone(caches["default"].get(microcache.make_key(
+                "flight", middleware.ruleset.version, str(slow) + "?page=2",
+                [("messages", "")]
+            )))
+            self.assertEqual(len(views.renders), 2)
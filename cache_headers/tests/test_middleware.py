@@ -1,9 +1,28 @@
+import sys
+from importlib import import_module
+from unittest import skipIf
+
+import django
 from django.contrib import auth
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.core.exceptions import SuspiciousOperation
-from django.test import TestCase
+from django.contrib.auth.models import AnonymousUser
+from django.core.exceptions import ImproperlyConfigured, SuspiciousOperation
+from django.http import (
+    HttpResponse, HttpResponseGone, HttpResponseNotFound,
+    HttpResponsePermanentRedirect, HttpResponseRedirect,
+    HttpResponseServerError, StreamingHttpResponse
+)
+from django.template import Context, Template
+from django.test import RequestFactory, TestCase
 from django.urls import reverse, reverse_lazy
+from django.utils.functional import SimpleLazyObject
+
+from cache_headers import middleware, signals
+from cache_headers.rules import RuleSet
+
+if sys.version_info >= (3, 5):
+    from cache_headers.tests.asynchronous import run_async_middleware
 
 
 all_users = reverse_lazy("all-users")
@@ -235,3 +254,362 @@ class CacheMiddlewareTest(TestCase):
         )
         self.failUnless("X-Is-Special-User" in response._headers["vary"][1])
 
+
+class LazyUserTest(TestCase):
+
+    def get_response(self, path):
+        evaluated = []
+
+        def get_user():
+            evaluated.append(True)
+            return AnonymousUser()
+
+        request = RequestFactory().get(path)
+        request.user = SimpleLazyObject(get_user)
+        response = middleware.CacheHeadersMiddleware().process_response(
+            request, HttpResponse()
+        )
+        return response, bool(evaluated)
+
+    def test_user_not_evaluated(self):
+        di = settings.CACHE_HEADERS.copy()
+        di["enable-tampering-checks"] = True
+        with self.settings(CACHE_HEADERS=di):
+            response, evaluated = self.get_response(str(all_users))
+            self.assertEqual(response["Cache-Control"], "max-age=100, s-maxage=600")
+            self.assertFalse(evaluated)
+
+            response, evaluated = self.get_response(str(anonymous_only))
+            self.assertEqual(response["Cache-Control"], "max-age=100, s-maxage=600")
+            self.assertTrue(evaluated)
+
+
+class StaleTest(TestCase):
+
+    def test_stale(self):
+        request = RequestFactory().get("/stale/")
+        request.user = AnonymousUser()
+        response = middleware.CacheHeadersMiddleware().process_response(
+            request, HttpResponse()
+        )
+        self.assertEqual(
+            response["Cache-Control"],
+            "max-age=100, s-maxage=300, stale-while-revalidate=30, stale-if-error=3600"
+        )
+
+
+class CacheTagsTest(TestCase):
+
+    def test_tags(self):
+        user = get_user_model().objects.create(username="tagged")
+        request = RequestFactory().get(str(all_users))
+        request.user = AnonymousUser()
+        Template(
+            "{% load cache_headers_tags %}{% cache_tags user \"news\" %}"
+        ).render(Context({"request": request, "user": user}))
+        response = middleware.CacheHeadersMiddleware().process_response(
+            request, HttpResponse()
+        )
+        self.assertEqual(response["xkey"], "auth.user-%s news" % user.pk)
+
+
+class PathOnlyMatchTest(TestCase):
+
+    def setUp(self):
+        super(PathOnlyMatchTest, self).setUp()
+        self.saved = middleware.ruleset
+        middleware.ruleset = RuleSet({
+            "all-users": {600: ("^/all-users/",)},
+            "per-user": {60: (r"^/all-users/\?page=",)}
+        }, path_only=True, max_entries=2)
+
+    def tearDown(self):
+        middleware.ruleset = self.saved
+        super(PathOnlyMatchTest, self).tearDown()
+
+    def test_query_strings_share_an_entry(self):
+        for n in range(5):
+            response = self.client.get(all_users, {"utm_source": n})
+            self.assertEqual(
+                response._headers["x-hash-cookies"], ("X-Hash-Cookies", "messages")
+            )
+        stats = middleware.ruleset.matcher.cache.stats()
+        self.assertEqual(stats["entries"], 1)
+        self.assertEqual(stats["hits"], 4)
+
+    def test_query_aware_rule(self):
+        response = self.client.get(all_users, {"page": 2})
+        self.assertEqual(
+            response._headers["x-hash-cookies"],
+            ("X-Hash-Cookies", "messages|%s" % settings.SESSION_COOKIE_NAME)
+        )
+
+
+class MessagesTest(TestCase):
+
+    def tearDown(self):
+        middleware.MESSAGES_MODE = "redirect"
+        super(MessagesTest, self).tearDown()
+
+    def get_response(self, path):
+        request = RequestFactory().get(path)
+        request.user = AnonymousUser()
+        request._messages = ["Saved"]
+        return middleware.CacheHeadersMiddleware().process_response(
+            request, HttpResponse()
+        )
+
+    def test_redirect(self):
+        response = self.get_response(str(all_users))
+        self.assertEqual(response.status_code, 302)
+        self.assertIn("?dch-uuid=", response["Location"])
+
+        response = self.get_response(response["Location"])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Cache-Control"], "no-cache")
+
+    def test_private(self):
+        middleware.MESSAGES_MODE = "private"
+        response = self.get_response(str(all_users))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Cache-Control"], "private, no-store")
+
+
+class ResolverRulesTest(TestCase):
+
+    def setUp(self):
+        super(ResolverRulesTest, self).setUp()
+        self.saved = middleware.ruleset
+        middleware.ruleset = RuleSet({
+            "all-users": {
+                300: {"url-names": ("blog:detail",)},
+                120: {"namespaces": ("blog",), "patterns": ("^/blog/",)},
+                600: ("^/decorated/",)
+            },
+            "per-user": {
+                30: {"views": ("django.views.generic.base.TemplateView",)}
+            }
+        })
+
+    def tearDown(self):
+        middleware.ruleset = self.saved
+        super(ResolverRulesTest, self).tearDown()
+
+    def test_url_name(self):
+        response = self.client.get("/blog/1/")
+        self.assertEqual(response["Cache-Control"], "max-age=100, s-maxage=300")
+
+    def test_namespace(self):
+        response = self.client.get("/blog/archive/")
+        self.assertEqual(response["Cache-Control"], "max-age=100, s-maxage=120")
+
+    def test_decorator(self):
+        # The decorator wins over the pattern
+        response = self.client.get("/decorated/")
+        self.assertEqual(response["Cache-Control"], "max-age=100, s-maxage=60")
+        self.assertEqual(
+            response["X-Hash-Cookies"],
+            "messages|%s" % settings.SESSION_COOKIE_NAME
+        )
+
+    def test_view(self):
+        response = self.client.get(all_users)
+        self.assertEqual(response["Cache-Control"], "max-age=100, s-maxage=30")
+
+    def test_pattern_fallback(self):
+        # Not resolved so only the pattern applies
+        response = self.client.get("/blog/missing/")
+        self.assertEqual(response.status_code, 404)
+        request = RequestFactory().get("/blog/missing/")
+        self.assertEqual(
+            middleware.CacheHeadersMiddleware().match(request).timeout, 120
+        )
+
+
+class StatusTimeoutsTest(TestCase):
+
+    def setUp(self):
+        super(StatusTimeoutsTest, self).setUp()
+        self.saved = middleware.ruleset
+        middleware.ruleset = RuleSet({
+            "all-users": {
+                600: {
+                    "patterns": ("^/all-users/",),
+                    "status-timeouts": {"404": 60, 301: 86400, 302: 30}
+                }
+            }
+        })
+
+    def tearDown(self):
+        middleware.ruleset = self.saved
+        super(StatusTimeoutsTest, self).tearDown()
+
+    def get_response(self, response, session=None, cookies=None):
+        request = RequestFactory().get(str(all_users))
+        request.user = AnonymousUser()
+        if session is not None:
+            request.session = session
+        request.COOKIES.update(cookies or {})
+        return middleware.CacheHeadersMiddleware().process_response(
+            request, response
+        )
+
+    def test_status_timeouts(self):
+        response = self.get_response(HttpResponseNotFound())
+        self.assertEqual(response["Cache-Control"], "max-age=100, s-maxage=60")
+        self.assertEqual(response["X-Accel-Expires"], "60")
+        response = self.get_response(HttpResponsePermanentRedirect("/"))
+        self.assertEqual(
+            response["Cache-Control"], "max-age=100, s-maxage=86400"
+        )
+        response = self.get_response(HttpResponse())
+        self.assertEqual(response["Cache-Control"], "max-age=100, s-maxage=600")
+
+    def test_not_cached(self):
+        # Statuses without a timeout and server errors are left alone
+        for response in (HttpResponseGone(), HttpResponseServerError()):
+            response = self.get_response(response)
+            self.assertFalse(response.has_header("Cache-Control"))
+        with self.assertRaises(ImproperlyConfigured):
+            RuleSet({"all-users": {60: {"status-timeouts": {503: 10}}}})
+
+    def test_session_specific_redirect(self):
+        session = import_module(settings.SESSION_ENGINE).SessionStore()
+        response = self.get_response(HttpResponseRedirect("/"), session)
+        self.assertEqual(response["Cache-Control"], "max-age=100, s-maxage=30")
+
+        # Reading the session may have decided the target
+        session.get("next")
+        response = self.get_response(HttpResponseRedirect("/"), session)
+        self.assertFalse(response.has_header("Cache-Control"))
+
+        response = self.get_response(
+            HttpResponseRedirect("/?sid=abcdefgh"),
+            cookies={settings.SESSION_COOKIE_NAME: "abcdefgh"}
+        )
+        self.assertFalse(response.has_header("Cache-Control"))
+
+
+class ConditionalGetTest(TestCase):
+
+    def setUp(self):
+        super(ConditionalGetTest, self).setUp()
+        middleware.CONDITIONAL_GET = True
+
+    def tearDown(self):
+        middleware.CONDITIONAL_GET = False
+        super(ConditionalGetTest, self).tearDown()
+
+    def test_etag(self):
+        response = self.client.get(all_users)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["ETag"].startswith('W/"'))
+
+        response = self.client.get(
+            all_users, HTTP_IF_NONE_MATCH=response["ETag"]
+        )
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["Cache-Control"], "max-age=100, s-maxage=600")
+
+        response = self.client.get(all_users, HTTP_IF_NONE_MATCH='W/"x"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_last_modified(self):
+        response = self.client.get(all_users)
+        last_modified = response["Last-Modified"]
+        response = self.client.get(
+            all_users, HTTP_IF_MODIFIED_SINCE=last_modified
+        )
+        self.assertEqual(response.status_code, 304)
+
+        response = self.client.get(
+            all_users, HTTP_IF_MODIFIED_SINCE="Sun, 06 Nov 1994 08:49:37 GMT"
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def test_streaming(self):
+        request = RequestFactory().get(str(all_users))
+        request.user = AnonymousUser()
+        response = middleware.CacheHeadersMiddleware().process_response(
+            request, StreamingHttpResponse(iter(["a", "b"]))
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header("ETag"))
+
+
+@skipIf(django.VERSION < (3, 1), "Async middleware requires Django 3.1")
+class AsyncMiddlewareTest(TestCase):
+
+    def get_response(self, path):
+        threads = []
+
+        def get_user():
+            threads.append(True)
+            return AnonymousUser()
+
+        request = RequestFactory().get(path)
+        request.user = SimpleLazyObject(get_user)
+        response = run_async_middleware(
+            middleware.CacheHeadersMiddleware, request, HttpResponse()
+        )
+        return response, bool(threads)
+
+    def test_async(self):
+        response, evaluated = self.get_response(str(all_users))
+        self.assertEqual(response["Cache-Control"], "max-age=100, s-maxage=600")
+        self.assertFalse(evaluated)
+
+        # The user is evaluated in a thread. Evaluating it on the event loop
+        # would not be allowed.
+        response, evaluated = self.get_response(str(anonymous_only))
+        self.assertEqual(response["Cache-Control"], "max-age=100, s-maxage=600")
+        self.assertTrue(evaluated)
+
+        response, evaluated = self.get_response("/home/")
+        self.assertEqual(response["Cache-Control"], "no-cache")
+        self.assertFalse(evaluated)
+
+
+class InstrumentationTest(TestCase):
+
+    def setUp(self):
+        super(InstrumentationTest, self).setUp()
+        middleware.INSTRUMENT = True
+        middleware.ENABLE_INSTRUMENTATION = True
+        middleware.ENABLE_SERVER_TIMING = True
+        self.decisions = []
+        signals.cache_decision.connect(self.on_decision)
+
+    def tearDown(self):
+        signals.cache_decision.disconnect(self.on_decision)
+        middleware.INSTRUMENT = False
+        middleware.ENABLE_INSTRUMENTATION = False
+        middleware.ENABLE_SERVER_TIMING = False
+        super(InstrumentationTest, self).tearDown()
+
+    def on_decision(self, sender, **kwargs):
+        self.decisions.append(kwargs)
+
+    def test_instrumentation(self):
+        middleware.ruleset.matcher.cache.clear()
+        self.client.get(all_users)
+        response = self.client.get(all_users)
+        self.assertTrue(response["Server-Timing"].startswith("dch;dur="))
+        self.assertEqual(
+            response["X-Cache-Headers-Rule"],
+            "^/all-users/; policy=all-users; age=600; lookup=hit"
+        )
+
+        self.assertEqual(len(self.decisions), 2)
+        self.assertFalse(self.decisions[0]["lookup_hit"])
+        decision = self.decisions[1]
+        self.assertEqual(decision["path"], "/all-users/")
+        self.assertEqual(decision["pattern"], "^/all-users/")
+        self.assertEqual(decision["policy"], "all-users")
+        self.assertEqual(decision["age"], 600)
+        self.assertTrue(decision["lookup_hit"])
+        self.assertTrue(decision["elapsed_ns"] > 0)
+
+        response = self.client.get("/home/")
+        self.assertFalse(response.has_header("X-Cache-Headers-Rule"))
+        self.assertIsNone(self.decisions[2]["pattern"])
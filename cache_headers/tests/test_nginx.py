@@ -0,0 +1,117 @@
+import re
+
+from django.test import SimpleTestCase
+
+from cache_headers import nginx, vcl
+from cache_headers.rules import build_rules
+from cache_headers.tests.test_vcl import CORPUS, TIMEOUTS, evaluate
+
+
+def unquote(value):
+    if value.startswith('"'):
+        return re.sub(r"\\(.)", r"\1", value[1:-1])
+    return value
+
+
+def parse(lines):
+    """Return the map blocks in lines as a dictionary of (subject, default,
+    entries) tuples keyed on the variable they set."""
+
+    result = {}
+    for line in lines:
+        match = re.match(r"map \$(\S+) \$(\S+) \{", line)
+        if match is not None:
+            block = result[match.group(2)] = [match.group(1), None, []]
+            continue
+        match = re.match(r'\s+("(?:[^"\\]|\\.)*"|\S+) (\S+);$', line)
+        if match is not None:
+            key, value = unquote(match.group(1)), unquote(match.group(2))
+            if key == "default":
+                block[1] = value
+            else:
+                block[2].append((key, value))
+    return result
+
+
+def lookup(blocks, variable, values):
+    """Return the value nginx would give variable. values holds the values
+    of variables that are not set by a map."""
+
+    if variable not in blocks:
+        return values[variable]
+    subject, default, entries = blocks[variable]
+    subject = lookup(blocks, subject, values)
+    for key, value in entries:
+        if key.startswith("~"):
+            # Python spells the named groups of PCRE differently
+            regex = re.sub(r"\(\?<(?=\w)", "(?P<", key[1:])
+            match = re.search(regex, subject)
+            if match is None:
+                continue
+            groups = match.groupdict()
+        elif key == subject:
+            groups = {}
+        else:
+            continue
+        return re.sub(
+            r"\$(\w+)",
+            lambda m: groups[m.group(1)] if m.group(1) in groups
+                else lookup(blocks, m.group(1), values),
+            value
+        )
+    if default.startswith("$"):
+        return lookup(blocks, default[1:], values)
+    return default
+
+
+class MapsTest(SimpleTestCase):
+
+    def check(self, path_only):
+        branches = vcl.dispatch(
+            build_rules(TIMEOUTS), lambda rule: rule.cache_type, path_only
+        )
+        lines = nginx.maps(
+            branches, "dch_policy", lambda v: nginx.string(v or ""), '""',
+            path_only
+        )
+        blocks = parse(nginx.PATH_MAP + lines)
+        for url in CORPUS:
+            self.assertEqual(
+                lookup(blocks, "dch_policy", {"request_uri": url}) or None,
+                evaluate(branches, url, path_only),
+                url
+            )
+        return blocks
+
+    def test_maps(self):
+        self.assertEqual(len(self.check(path_only=False)), 2)
+
+    def test_path_only(self):
+        # Query aware rules are tested in their own maps
+        self.assertTrue(len(self.check(path_only=True)) > 2)
+
+    def test_string(self):
+        self.assertEqual(nginx.string("^/a\\?"), '"^/a\\\\?"')
+        self.assertEqual(nginx.string('a"b'), '"a\\"b"')
+
+
+class HashValueTest(SimpleTestCase):
+
+    def test_hash_value(self):
+        lines, variables = nginx.cookie_variables(["messages", "my-region"])
+        self.assertEqual(variables["messages"], "$cookie_messages")
+        lines.extend(nginx.hash_value(
+            ["messages|my-region", "messages"], variables
+        ))
+        blocks = parse(lines)
+        values = {
+            "http_cookie": "a=1; my-region=eu; b=2",
+            "cookie_messages": "x"
+        }
+        values["dch_hash_cookies"] = "messages|my-region"
+        self.assertEqual(
+            lookup(blocks, "dch_hash_value", values),
+            ";messages=x;my-region=eu"
+        )
+        values["dch_hash_cookies"] = ""
+        self.assertEqual(lookup(blocks, "dch_hash_value", values), "")
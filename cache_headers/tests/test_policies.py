@@ -0,0 +1,35 @@
+from django.http import HttpResponse
+from django.test import SimpleTestCase
+
+from cache_headers import policies
+
+
+class HeaderBundleTest(SimpleTestCase):
+
+    def test_bundles(self):
+        bundle = policies.header_bundle(policies.anonymous_only, 60, False)
+        self.assertIs(
+            bundle, policies.header_bundle(policies.anonymous_only, 60, False)
+        )
+        headers, cacheable = bundle
+        self.assertTrue(cacheable)
+        self.assertEqual(
+            dict(headers)["Cache-Control"], "max-age=100, s-maxage=60"
+        )
+
+        headers, cacheable = policies.header_bundle(
+            policies.anonymous_only, 60, True
+        )
+        self.assertFalse(cacheable)
+        self.assertEqual(
+            dict(headers)["Cache-Control"], "no-cache"
+        )
+
+    def test_apply_policy(self):
+        response = HttpResponse()
+        policies.all_users(None, response, None, 60)
+        self.assertEqual(response["Cache-Control"], "max-age=100, s-maxage=60")
+        self.assertEqual(response["X-Accel-Expires"], "60")
+        self.assertEqual(response["X-Hash-Cookies"], "messages")
+        self.assertEqual(response["Vary"], "Accept-Encoding,Cookie")
+        self.assertTrue(response.has_header("Last-Modified"))
@@ -0,0 +1,169 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+from unittest import skipIf
+
+import django
+from django.contrib.auth.models import AnonymousUser
+from django.core.exceptions import ImproperlyConfigured
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase
+
+from cache_headers import middleware, signals
+from cache_headers.providers import FileProvider, SettingsProvider
+
+if sys.version_info >= (3, 5):
+    from cache_headers.tests.asynchronous import run_async_middleware
+
+
+class FileProviderTest(TestCase):
+
+    def setUp(self):
+        super(FileProviderTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "rules.json")
+        self.write({"all-users": {"60": ["^/file/"]}})
+        self.saved = (
+            middleware.provider, middleware.ruleset, middleware.rules
+        )
+        middleware.provider = FileProvider(self.path)
+
+    def tearDown(self):
+        middleware.provider, middleware.ruleset, middleware.rules = self.saved
+        shutil.rmtree(self.directory)
+        super(FileProviderTest, self).tearDown()
+
+    def write(self, timeouts, mtime=None):
+        with open(self.path, "w") as fp:
+            json.dump(timeouts, fp)
+        if mtime is not None:
+            os.utime(self.path, (mtime, mtime))
+
+    def get_response(self, path):
+        request = RequestFactory().get(path)
+        request.user = AnonymousUser()
+        return middleware.CacheHeadersMiddleware().process_response(
+            request, HttpResponse()
+        )
+
+    def test_load(self):
+        self.write({
+            "all-users": {
+                "60": ["^/a/"],
+                "300": {"patterns": ["^/b/"], "stale-if-error": 10}
+            }
+        })
+        version, timeouts = FileProvider(self.path).load()
+        self.assertEqual(version, FileProvider(self.path).version())
+        self.assertEqual(timeouts["all-users"][60], ("^/a/",))
+        self.assertEqual(timeouts["all-users"][300]["patterns"], ("^/b/",))
+
+        # Timeouts may select views only
+        self.write({"all-users": {"60": {"url-names": ["greeting"]}}})
+        version, timeouts = FileProvider(self.path).load()
+        self.assertEqual(timeouts["all-users"][60], {
+            "patterns": (), "url-names": ("greeting",)
+        })
+
+    def test_reload(self):
+        self.assertTrue(middleware.reload_rules())
+        self.assertFalse(middleware.reload_rules())
+        old = middleware.ruleset
+        self.assertEqual(
+            self.get_response("/file/")["Cache-Control"],
+            "max-age=100, s-maxage=60"
+        )
+
+        self.write({"all-users": {"120": ["^/file/"]}}, mtime=1)
+        self.assertTrue(middleware.reload_rules())
+        self.assertIsNot(middleware.ruleset, old)
+        # The new rule set starts with an empty lookup cache
+        self.assertEqual(middleware.ruleset.matcher.cache.stats()["entries"], 0)
+        self.assertEqual(
+            self.get_response("/file/")["Cache-Control"],
+            "max-age=100, s-maxage=120"
+        )
+
+    def test_unknown_policy(self):
+        middleware.reload_rules()
+        old = middleware.ruleset
+        self.write({"all-userz": {"120": ["^/file/"]}}, mtime=1)
+        with self.assertRaises(ImproperlyConfigured):
+            middleware.reload_rules()
+        self.assertIs(middleware.ruleset, old)
+        self.assertEqual(
+            self.get_response("/file/")["Cache-Control"],
+            "max-age=100, s-maxage=60"
+        )
+
+    def test_poll(self):
+        middleware.reload_rules()
+        saved = (middleware.RULES_CHECK_INTERVAL, middleware._next_check)
+        middleware.RULES_CHECK_INTERVAL = 60
+        middleware._next_check = 0
+        try:
+            self.write({"all-users": {"120": ["^/file/"]}}, mtime=1)
+            self.assertEqual(
+                self.get_response("/file/")["Cache-Control"],
+                "max-age=100, s-maxage=120"
+            )
+            # Not checked again within the interval
+            self.write({"all-users": {"180": ["^/file/"]}}, mtime=2)
+            self.assertEqual(
+                self.get_response("/file/")["Cache-Control"],
+                "max-age=100, s-maxage=120"
+            )
+            # A broken file leaves the rules in place
+            with open(self.path, "w") as fp:
+                fp.write("{")
+            middleware._next_check = 0
+            self.assertEqual(
+                self.get_response("/file/")["Cache-Control"],
+                "max-age=100, s-maxage=120"
+            )
+        finally:
+            middleware.RULES_CHECK_INTERVAL, middleware._next_check = saved
+
+    @skipIf(django.VERSION < (3, 1), "Async middleware requires Django 3.1")
+    def test_poll_async(self):
+        from django.utils.asyncio import async_unsafe
+
+        class DatabaseProvider(FileProvider):
+            # Like a provider that queries the database
+            version = async_unsafe(FileProvider.version)
+            load = async_unsafe(FileProvider.load)
+
+        middleware.provider = DatabaseProvider(self.path)
+        middleware.reload_rules()
+        saved = (middleware.RULES_CHECK_INTERVAL, middleware._next_check)
+        middleware.RULES_CHECK_INTERVAL = 60
+        middleware._next_check = 0
+        try:
+            self.write({"all-users": {"120": ["^/file/"]}}, mtime=1)
+            request = RequestFactory().get("/file/")
+            request.user = AnonymousUser()
+            response = run_async_middleware(
+                middleware.CacheHeadersMiddleware, request, HttpResponse()
+            )
+            self.assertEqual(
+                response["Cache-Control"], "max-age=100, s-maxage=120"
+            )
+            self.assertIs(middleware.rules, middleware.ruleset.rules)
+        finally:
+            middleware.RULES_CHECK_INTERVAL, middleware._next_check = saved
+
+    def test_signal(self):
+        middleware.reload_rules()
+        old = middleware.ruleset
+        signals.rules_changed.send(sender=None)
+        self.assertIsNot(middleware.ruleset, old)
+
+
+class SettingsProviderTest(TestCase):
+
+    def test_load(self):
+        version, timeouts = SettingsProvider().load()
+        self.assertEqual(version, SettingsProvider().version())
+        self.assertIn("all-users", timeouts)
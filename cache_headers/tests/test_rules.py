@@ -0,0 +1,70 @@
+from django.test import SimpleTestCase
+
+from cache_headers.rules import RuleMatcher, build_rules, is_query_aware
+from cache_headers.utils import LRUCache
+
+
+TIMEOUTS = {
+    "all-users": {
+        60: ("^/news/", "^/about/$"),
+        600: ("^/news/archive/",)
+    },
+    "per-user": {
+        30: ("^/news/archive/mine/", "^/account/")
+    }
+}
+
+
+class RuleMatcherTest(SimpleTestCase):
+
+    def linear(self, rules, path):
+        for rule in rules:
+            if rule.pattern.match(path):
+                return rule
+        return None
+
+    def test_order(self):
+        rules = build_rules(TIMEOUTS)
+        self.assertEqual(
+            [r.length for r in rules], sorted([r.length for r in rules], reverse=True)
+        )
+        matcher = RuleMatcher(rules)
+        self.assertIsNotNone(matcher.combined)
+        for path in (
+            "/news/", "/news/1/", "/news/archive/", "/news/archive/mine/x/",
+            "/about/", "/about/x/", "/account/", "/", "/other/?a=1"
+        ):
+            self.assertEqual(matcher.match(path), self.linear(rules, path))
+            # Second lookup is served from the LRU
+            self.assertEqual(matcher.match(path), self.linear(rules, path))
+
+        rule = matcher.match("/news/archive/mine/")
+        self.assertEqual((rule.timeout, rule.cache_type), (30, "per-user"))
+        self.assertIsNone(matcher.match("/"))
+
+    def test_uncombinable(self):
+        rules = build_rules({"all-users": {60: (r"^/(\w+)/\1/$", "^/a/")}})
+        matcher = RuleMatcher(rules)
+        self.assertIsNone(matcher.combined)
+        self.assertEqual(matcher.match("/x/x/").timeout, 60)
+        self.assertIsNone(matcher.match("/x/y/"))
+
+    def test_query_aware(self):
+        rules = build_rules({"all-users": {60: ("^/news/$", r"^/news/\?page=")}})
+        self.assertEqual(
+            [is_query_aware(r) for r in rules], [True, False]
+        )
+
+    def test_lru(self):
+        cache = LRUCache(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(
+            cache.stats(),
+            {"entries": 2, "max_entries": 2, "hits": 2, "misses": 1, "evictions": 1}
+        )
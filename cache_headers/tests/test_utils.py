@@ -0,0 +1,34 @@
+from django.test import SimpleTestCase
+
+from cache_headers.utils import httpdate_now, session_key_validator
+
+
+class SessionKeyValidatorTest(SimpleTestCase):
+
+    def test_db(self):
+        validate = session_key_validator("django.contrib.sessions.backends.db")
+        self.assertTrue(validate("abcdefgh12345678"))
+        self.assertFalse(validate("1234567"))
+        self.assertFalse(validate("ABCDEFGH12345678"))
+        self.assertFalse(validate("abcdefgh;12345678"))
+
+    def test_signed_cookies(self):
+        validate = session_key_validator(
+            "django.contrib.sessions.backends.signed_cookies"
+        )
+        self.assertTrue(validate("eyJhIjoxfQ:1kT8Yz:AbCd"))
+        self.assertFalse(validate("1234567"))
+
+
+class HttpdateTest(SimpleTestCase):
+
+    def test_httpdate_now(self):
+        self.assertEqual(
+            httpdate_now(lambda: 784111777.5), "Sun, 06 Nov 1994 08:49:37 GMT"
+        )
+        self.assertEqual(
+            httpdate_now(lambda: 784111777.9), "Sun, 06 Nov 1994 08:49:37 GMT"
+        )
+        self.assertEqual(
+            httpdate_now(lambda: 784111778), "Sun, 06 Nov 1994 08:49:38 GMT"
+        )
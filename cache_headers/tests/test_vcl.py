@@ -0,0 +1,166 @@
+import re
+
+from django.conf import settings
+from django.test import SimpleTestCase
+
+from cache_headers import policies, vcl
+from cache_headers.rules import (
+    RuleMatcher, build_resolver_rules, build_rules, is_query_aware
+)
+
+
+TIMEOUTS = {
+    "all-users": {
+        60: ("^/news/", "^/about/$", "^/shop/[0-9]+/"),
+        600: ("^/news/archive/", "^/search/\\?q=")
+    },
+    "per-user": {
+        30: ("^/news/archive/mine/", "^/account/", "^/shop/cart/", "/feed/")
+    },
+    "anonymous-only": {
+        0: ("^/news/archive/mine/draft/",)
+    }
+}
+
+CORPUS = (
+    "/", "/news/", "/news/1/", "/news/archive/", "/news/archive/2018/",
+    "/news/archive/mine/", "/news/archive/mine/draft/", "/about/",
+    "/about/x/", "/account/", "/account/?next=/", "/shop/1/", "/shop/cart/",
+    "/shop/cart/1/", "/search/?q=x", "/search/", "/x/feed/", "/feed/",
+    "/news/feed/", "/news/?page=2", "/other/?a=/news/"
+)
+
+
+def evaluate(branches, url, path_only=False):
+    """Return the value of the first branch that matches the way Varnish
+    would, or None."""
+
+    for regex, value, query_aware in branches:
+        subject = url
+        if path_only and not query_aware:
+            subject = re.sub(r"\?.*$", "", url)
+        if re.search(regex, subject):
+            return value
+    return None
+
+
+class DispatchTest(SimpleTestCase):
+
+    def check(self, rules, outcome, path_only=False):
+        branches = vcl.dispatch(rules, outcome, path_only)
+        matcher = RuleMatcher(rules)
+        for url in CORPUS:
+            path = re.sub(r"\?.*$", "", url)
+            if path_only:
+                # Mirror the middleware's lookup in path only mode
+                candidates = [
+                    r for r in rules
+                    if r.pattern.match(url if is_query_aware(r) else path)
+                ]
+                candidates.sort(
+                    key=lambda r: (-r.length, not is_query_aware(r))
+                )
+                rule = candidates[0] if candidates else None
+            else:
+                rule = matcher.match(url)
+            expected = outcome(rule) if rule is not None else None
+            self.assertEqual(
+                evaluate(branches, url, path_only), expected, url
+            )
+        return branches
+
+    def test_cache_type(self):
+        rules = build_rules(TIMEOUTS)
+        branches = self.check(rules, lambda rule: rule.cache_type)
+        self.assertTrue(len(branches) < len(rules))
+
+    def test_timeout(self):
+        rules = build_rules(TIMEOUTS)
+        self.check(rules, lambda rule: rule.timeout or None)
+
+    def test_path_only(self):
+        rules = build_rules(TIMEOUTS)
+        self.check(rules, lambda rule: rule.cache_type, path_only=True)
+
+    def test_named_groups(self):
+        rules = build_rules({"all-users": {60: (
+            r"^/news/(?P<slug>[-\w]+)/$", r"^/blog/(?P<slug>[-\w]+)/$"
+        )}})
+        branches = self.check(rules, lambda rule: rule.cache_type)
+        self.assertEqual(len(branches), 1)
+        self.assertNotIn("?P<", branches[0][0])
+        re.compile(branches[0][0])
+
+    def test_alternation(self):
+        # Every alternative is anchored, like the middleware matches them
+        rules = build_rules({"all-users": {60: ("^/a/|/b/",)}})
+        branches = vcl.dispatch(rules, lambda rule: rule.cache_type)
+        matcher = RuleMatcher(rules)
+        for url in ("/a/", "/b/", "/x/b/", "/x/a/"):
+            rule = matcher.match(url)
+            self.assertEqual(
+                evaluate(branches, url),
+                rule.cache_type if rule is not None else None, url
+            )
+
+    def test_string(self):
+        self.assertEqual(vcl.string("^/a/"), '"^/a/"')
+        self.assertEqual(vcl.string('^/"a"/'), '{"^/"a"/"}')
+
+
+@policies.declare(("messages", "region"), needs_user=False)
+def regional(request, response, user, age):
+    policies.apply_policy(regional, request, response, user, age)
+
+
+class HashCookiesTest(SimpleTestCase):
+
+    def test_names(self):
+        rules = build_rules({
+            "regional": {60: ("^/shop/",)},
+            "per-user": {60: ("^/account/",)}
+        })
+        names = vcl.hash_cookie_names(
+            {"regional": regional, "per-user": policies.per_user}, rules
+        )
+        self.assertEqual(
+            sorted(names),
+            sorted(["messages", "region", settings.SESSION_COOKIE_NAME])
+        )
+
+    def test_cookie_module(self):
+        lines = vcl.hash_value(["region"], cookie_module=True)
+        self.assertEqual(lines[0], "cookie.parse(req.http.Cookie);")
+        self.assertIn('cookie.get("region")', lines[2])
+        self.assertNotIn("regsub", "".join(lines))
+
+    def test_regex(self):
+        line = vcl.hash_value(["region"])[2]
+        regex = re.search(r'regsub\(req\.http\.Cookie, "([^"]*)"', line).group(1)
+        for cookie, value in (
+            ("region=eu", "eu"),
+            ("a=1; region=eu; b=2", "eu"),
+            ("subregion=us; region=eu", "eu"),
+        ):
+            self.assertEqual(re.sub(regex, r"\2", cookie), value)
+
+
+class ResolverRulesTest(SimpleTestCase):
+
+    def test_resolver_rules(self):
+        rules = vcl.resolver_rules(build_resolver_rules({
+            "all-users": {
+                300: {"url-names": ("blog:detail",)},
+                120: {"namespaces": ("blog",)}
+            }
+        }))
+        self.assertEqual(
+            [(r.pattern.pattern, r.timeout) for r in rules],
+            [
+                (r"^/decorated/(?:\?|$)", 60),
+                (r"^/blog/(?:\d+)/(?:\?|$)", 300),
+                (r"^/blog/archive/(?:\?|$)", 120)
+            ]
+        )
+        self.assertTrue(rules[1].pattern.match("/blog/1/?page=2"))
+        self.assertFalse(rules[1].pattern.match("/blog/1/x/"))
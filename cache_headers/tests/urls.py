@@ -1,9 +1,24 @@
 from django.conf.urls import include, url
 from django.views.generic import TemplateView
 
+from cache_headers.decorators import cache_policy
 from cache_headers.tests import views
 
 
+blog_patterns = [
+    url(
+        r"^(?P<pk>\d+)/$",
+        TemplateView.as_view(template_name="tests/view.html"),
+        name="detail"
+    ),
+    url(
+        r"^archive/$",
+        TemplateView.as_view(template_name="tests/view.html"),
+        name="archive"
+    )
+]
+
+
 urlpatterns = [
     url(
         r"^mylogin/$", views.mylogin, name="mylogin"
@@ -40,5 +55,20 @@ urlpatterns = [
         r"^home/$",
         TemplateView.as_view(template_name="tests/view.html"),
         name="home"
-    )
+    ),
+    url(
+        r"^decorated/$",
+        cache_policy(60, "per-user")(
+            TemplateView.as_view(template_name="tests/view.html")
+        ),
+        name="decorated"
+    ),
+    url(r"^blog/", include((blog_patterns, "blog"), namespace="blog")),
+    url(r"^all-users/slow/$", views.slow, name="slow"),
+    url(
+        r"^all-users/esi/$",
+        TemplateView.as_view(template_name="tests/esi.html"),
+        name="esi"
+    ),
+    url(r"^per-user/greeting/$", views.greeting, name="greeting")
 ]
@@ -1,3 +1,5 @@
+import time
+
 from django.contrib.auth import authenticate, login, logout
 from django.http import HttpResponse
 
@@ -16,3 +18,17 @@ def mylogin(request):
 def mylogout(request):
     logout(request)
     return HttpResponse("yay")
+
+
+# Calls to the slow view
+renders = []
+
+
+def slow(request):
+    renders.append(request.get_full_path())
+    time.sleep(0.2)
+    return HttpResponse("slow")
+
+
+def greeting(request):
+    return HttpResponse("Hello %s" % request.user.username)
@@ -1,3 +1,29 @@
+import datetime
+import re
+import threading
+import time
+from collections import OrderedDict
+from importlib import import_module
+
+from django.contrib.auth import SESSION_KEY
+from django.contrib.sessions.backends.base import SessionBase
+
+
+# Session engines that generate their keys from lowercase letters and digits
+SIMPLE_KEY_SESSION_ENGINES = (
+    "django.contrib.sessions.backends.cache",
+    "django.contrib.sessions.backends.cached_db",
+    "django.contrib.sessions.backends.db",
+    "django.contrib.sessions.backends.file",
+)
+
+simple_session_key = re.compile(r"[a-z0-9]{8,}\Z").match
+
+# The formatted date of the current second as a (timestamp, string) tuple. The
+# tuple is replaced as a whole so concurrent readers never see a mismatch.
+_httpdate_now = (None, None)
+
+
 def httpdate(dt):
     """Return a string representation of a date according to RFC 1123
     (HTTP/1.1).
@@ -10,3 +36,88 @@ def httpdate(dt):
              "Oct", "Nov", "Dec"][dt.month - 1]
     return "%s, %02d %s %04d %02d:%02d:%02d GMT" % (weekday, dt.day, month,
         dt.year, dt.hour, dt.minute, dt.second)
+
+
+def httpdate_now(clock=time.time):
+    """Return the current time formatted by httpdate. The string is formatted
+    at most once per second."""
+
+    global _httpdate_now
+    now = int(clock())
+    second, value = _httpdate_now
+    if second != now:
+        value = httpdate(datetime.datetime.utcfromtimestamp(now))
+        _httpdate_now = (now, value)
+    return value
+
+
+class LRUCache(object):
+    """A small thread-safe in-process mapping that holds at most max_entries
+    items, discarding the least recently used item when full.
+
+    Hits, misses and evictions are counted so the effectiveness of the cache
+    can be inspected through stats()."""
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {
+            "entries": len(self._data),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+
+def _underlying(method):
+    return getattr(method, "__func__", method)
+
+
+def session_key_validator(engine):
+    """Return a callable that validates a session key for the given session
+    engine without constructing a session store on every call.
+
+    Django's own engines are validated with a length and charset check.
+    Engines that override key validation get a single store instance that is
+    reused for all calls."""
+
+    store_class = import_module(engine).SessionStore
+    if _underlying(store_class._validate_session_key) \
+        is not _underlying(SessionBase._validate_session_key):
+        return store_class(SESSION_KEY)._validate_session_key
+    if engine in SIMPLE_KEY_SESSION_ENGINES:
+        return simple_session_key
+    return lambda key: len(key) >= 8
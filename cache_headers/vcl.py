@@ -0,0 +1,284 @@
+"""Helpers to translate the rules into Varnish VCL.
+
+Rules are not emitted as one regex per rule. Rules that lead to the same
+outcome are merged into a single regex, and a rule is moved forward into an
+earlier branch as long as no rule it jumps over can match the same URL. The
+first matching branch therefore always yields the same outcome as the first
+matching rule in the middleware."""
+
+import re
+
+from django.contrib.auth.models import User
+from django.http.response import HttpResponse
+from django.test.client import RequestFactory
+from django.urls import ResolverMatch, get_resolver
+
+from cache_headers.rules import (
+    UNSAFE_TO_COMBINE, is_query_aware, resolve
+)
+
+
+# A pattern that is a literal prefix, optionally anchored at the end too
+LITERAL = re.compile(r"\^((?:[^\\.^$*+?{}\[\]|()]|\\[^\w\s])*)(\$?)\Z")
+
+
+# Anchors at the end of URL patterns and named groups, which may not be
+# repeated in a combined regex
+END = re.compile(r"(\$|\\Z)$")
+NAMED_GROUP = re.compile(r"\(\?P<\w+>")
+
+
+def string(value):
+    """Return value as a VCL string literal."""
+
+    if '"' in value:
+        return '{"%s"}' % value
+    return '"%s"' % value
+
+
+def literal(rule):
+    """Return (text, exact) if the pattern of the rule matches a literal
+    prefix, or a literal URL if exact, otherwise None."""
+
+    match = LITERAL.match(rule.pattern.pattern)
+    if match is None:
+        return None
+    return re.sub(r"\\(.)", r"\1", match.group(1)), bool(match.group(2))
+
+
+def overlaps(a, b):
+    """Return False only if no URL can be matched by both rules."""
+
+    la = literal(a)
+    lb = literal(b)
+    if (la is None) or (lb is None):
+        return True
+    (ta, ea), (tb, eb) = la, lb
+    if ea and eb:
+        return ta == tb
+    if ea:
+        return ta.startswith(tb)
+    if eb:
+        return tb.startswith(ta)
+    return ta.startswith(tb) or tb.startswith(ta)
+
+
+def dispatch(rules, outcome, path_only=False, first=()):
+    """Return a list of (regex, value, query_aware) branches to be tested in
+    order. outcome is a callable returning the value for a rule. Branches
+    with a value of None do nothing, but they are kept if a later branch
+    may match the same URLs. In path only mode the branches that are not
+    query aware must be tested against the URL without its query string.
+    Rules in first, such as the result of resolver_rules, are tested before
+    all others in the given order."""
+
+    if path_only:
+        # On equal lengths query aware rules win, see the middleware
+        rules = sorted(
+            rules, key=lambda r: (-r.length, not is_query_aware(r))
+        )
+    rules = list(first) + list(rules)
+
+    groups = []
+    for rule in rules:
+        value = outcome(rule)
+        query_aware = path_only and is_query_aware(rule)
+        unsafe = UNSAFE_TO_COMBINE.search(rule.pattern.pattern)
+        target = None
+        for group in reversed(groups):
+            if (group[1] == value) and (group[2] == query_aware) \
+                    and not unsafe and not group[3]:
+                target = group
+            # Never jump over a rule that may match the same URL. Query
+            # aware rules are tested against another subject so cannot be
+            # compared.
+            if query_aware or group[2] \
+                    or any(overlaps(rule, other) for other in group[0]):
+                break
+        if target is None:
+            groups.append(([rule], value, query_aware, bool(unsafe)))
+        else:
+            target[0].append(rule)
+
+    # Branches that do nothing are only needed to stop URLs from falling
+    # through to later branches
+    for n in range(len(groups) - 1, -1, -1):
+        group_rules, value, query_aware, unsafe = groups[n]
+        if (value is None) and not any(
+            query_aware or later[2] or overlaps(rule, other)
+            for rule in group_rules
+            for later in groups[n + 1:]
+            for other in later[0]
+        ):
+            del groups[n]
+
+    branches = []
+    for group_rules, value, query_aware, unsafe in groups:
+        if len(group_rules) > 1:
+            # A group name may only be defined once in a regex
+            regex = "|".join(
+                NAMED_GROUP.sub("(?:", r.pattern.pattern) for r in group_rules
+            )
+        else:
+            regex = group_rules[0].pattern.pattern
+        # The middleware only matches at the start of the URL while Varnish
+        # searches all of it. A leading ^ only anchors the first alternative.
+        regex = "^(?:%s)" % regex
+        branches.append((regex, value, query_aware))
+    return branches
+
+
+def chain(branches, url, body, path_only=False, indent="    "):
+    """Return the lines of an if / else if chain over branches. url is the
+    VCL variable holding the URL and body a callable returning the lines of a
+    branch for its value."""
+
+    path = 'regsub(%s, "\\?.*$", "")' % url
+    lines = []
+    for n, (regex, value, query_aware) in enumerate(branches):
+        lines.append("%s%s (%s ~ %s) {" % (
+            indent,
+            "if" if n == 0 else "else if",
+            path if (path_only and not query_aware) else url,
+            string(regex)
+        ))
+        for line in body(value):
+            lines.append("%s    %s" % (indent, line))
+        lines.append("%s}" % indent)
+    return lines
+
+
+def hash_cookies(policy, age):
+    """Return the cookies that vary the cache for a policy, joined by |."""
+
+    if hasattr(policy, "hash_cookies"):
+        return "|".join(policy.hash_cookies)
+    # Undeclared policies have to be called to find out
+    response = HttpResponse()
+    policy(RequestFactory().get("/"), response, User(), age)
+    return response.get("X-Hash-Cookies")
+
+
+def strip_cookies(cookies, cookie_module=False):
+    """Return the lines that remove all cookies from the request except the
+    given ones. The Cookie header is removed if nothing remains."""
+
+    lines = []
+    if not cookies:
+        lines.append("unset req.http.Cookie;")
+        return lines
+    if cookie_module:
+        lines.extend([
+            "cookie.parse(req.http.Cookie);",
+            "cookie.keep(%s);" % string(",".join(cookies)),
+            "set req.http.Cookie = cookie.get_string();"
+        ])
+    else:
+        lines.extend([
+            'set req.http.Cookie = ";" + req.http.Cookie;',
+            'set req.http.Cookie = regsuball(req.http.Cookie, "; +", ";");',
+            'set req.http.Cookie = regsuball(req.http.Cookie, ";(%s)=", "; \\1=");'
+                % "|".join(re.escape(c) for c in cookies),
+            'set req.http.Cookie = regsuball(req.http.Cookie, ";[^ ][^;]*", "");',
+            'set req.http.Cookie = regsuball(req.http.Cookie, "^[; ]+|[; ]+$", "");',
+        ])
+    lines.extend([
+        'if (req.http.Cookie == "") {',
+        '    unset req.http.Cookie;',
+        '}'
+    ])
+    return lines
+
+
+def hash_cookie_names(policies, rules):
+    """Return the names of all cookies the policies of the rules hash on, in
+    a stable order."""
+
+    names = []
+    for rule in rules:
+        value = hash_cookies(policies[rule.cache_type], rule.timeout)
+        for name in (value or "").split("|"):
+            if name and (name not in names):
+                names.append(name)
+    return names
+
+
+def hash_value(names, cookie_module=False):
+    """Return the lines that add the value of every cookie listed in the
+    Hash-Cookies request header to the Hash-Value request header. With
+    cookie_module the header is parsed once by vmod_cookie, otherwise every
+    cookie is extracted with a regex anchored on the cookie boundary."""
+
+    lines = []
+    if cookie_module:
+        lines.append("cookie.parse(req.http.Cookie);")
+    for name in names:
+        escaped = re.escape(name)
+        if cookie_module:
+            value = "cookie.get(%s)" % string(name)
+        else:
+            value = 'regsub(req.http.Cookie, "^(.*; *)?%s=([^;]*).*$", "\\2")' \
+                % escaped
+        lines.append(
+            'if (req.http.Hash-Cookies ~ "(^|\\|)%s(\\||$)") {' % escaped
+        )
+        if not cookie_module:
+            lines.append('    if (req.http.Cookie ~ "(^|; *)%s=") {' % escaped)
+            indent = "        "
+        else:
+            indent = "    "
+        lines.append(
+            '%sset req.http.Hash-Value = req.http.Hash-Value + ";%s=" + %s;'
+            % (indent, name, value)
+        )
+        if not cookie_module:
+            lines.append("    }")
+        lines.append("}")
+    return lines
+
+
+def url_patterns(resolver=None, prefix="", namespaces=(), app_names=()):
+    """Yield a (regex, match) tuple for every URL pattern of the URLconf in
+    order. regex matches the full path from the start and match is the
+    resolver match the pattern would produce."""
+
+    if resolver is None:
+        resolver = get_resolver()
+    for pattern in resolver.url_patterns:
+        # Django 2.0 moved the regex to a pattern object
+        regex = getattr(pattern, "pattern", pattern).regex.pattern.lstrip("^")
+        regex = NAMED_GROUP.sub("(?:", regex)
+        if hasattr(pattern, "url_patterns"):
+            nested_namespaces = namespaces
+            nested_app_names = app_names
+            if pattern.namespace:
+                nested_namespaces += (pattern.namespace,)
+                nested_app_names += (pattern.app_name or pattern.namespace,)
+            for item in url_patterns(
+                pattern, prefix + regex, nested_namespaces, nested_app_names
+            ):
+                yield item
+        else:
+            match = END.search(regex)
+            if match is not None:
+                # The rules are matched against the path and query string
+                regex = regex[:match.start()] + "(?:\\?|$)"
+            yield "^/%s%s" % (prefix, regex), ResolverMatch(
+                pattern.callback, (), {}, pattern.name, list(app_names),
+                list(namespaces)
+            )
+
+
+def resolver_rules(resolver_rules):
+    """Return pattern rules equivalent to the rules that are resolved through
+    the resolver match, in URLconf order. They take precedence over the
+    pattern rules just like they do in the middleware."""
+
+    result = []
+    for regex, match in url_patterns():
+        rule = resolve(resolver_rules, match)
+        if rule is not None:
+            result.append(rule._replace(
+                pattern=re.compile(regex), length=len(regex)
+            ))
+    return result